@@ -0,0 +1,132 @@
+"""
+Per-node axis state cache fed from the heartbeats the ODrives send on their
+own, so waiting for a state change never has to read the bus directly and
+can't hang on a drive that stopped talking.
+
+See https://docs.odriverobotics.com/v/latest/manual/can-protocol.html for the
+heartbeat layout.
+"""
+import asyncio
+from dataclasses import dataclass
+import struct
+import time
+
+from can_simple_utils import CanDispatcher, HEARTBEAT_CMD
+from instrumentation import instruments
+
+# See ODrive.AxisState in the firmware's API reference
+IDLE = 1
+FULL_CALIBRATION_SEQUENCE = 3
+CLOSED_LOOP_CONTROL = 8
+
+PROCEDURE_SUCCESS = 0
+PROCEDURE_BUSY = 1
+
+# See ODrive.ProcedureResult in the firmware's API reference
+PROCEDURE_RESULTS = {
+    0: "SUCCESS", 1: "BUSY", 2: "CANCELLED", 3: "DISARMED", 4: "NO_RESPONSE",
+    5: "POLE_PAIR_CPR_MISMATCH", 6: "PHASE_RESISTANCE_OUT_OF_RANGE", 7: "PHASE_INDUCTANCE_OUT_OF_RANGE",
+    8: "UNBALANCED_PHASES", 9: "INVALID_MOTOR_TYPE", 10: "ILLEGAL_HALL_STATE", 11: "TIMEOUT",
+    12: "HOMING_WITHOUT_ENDSTOP", 13: "INVALID_STATE", 14: "NOT_CALIBRATED", 15: "NOT_CONVERGING",
+}
+
+HEARTBEAT = struct.Struct('<IBBB') # axis error, axis state, procedure result, trajectory done
+
+
+@dataclass(frozen=True)
+class AxisStatus():
+    node_id: int
+    state: int = None
+    error: int = 0
+    procedure_result: int = None
+    traj_done: bool = None
+    last_seen: float = None # time.monotonic() of the last heartbeat, None before the first one
+
+
+class AxisStateTracker():
+    """
+    Keeps the last heartbeat of every node of `node_ids` received through
+    `dispatcher` (or a NodeRegistry, for nodes on several buses).
+
+    The waits return right away when the cache already satisfies them, and
+    otherwise return the node ids still lagging once `timeout` runs out
+    (an empty list meaning success). `since` (a time.monotonic() value) makes
+    them ignore heartbeats older than a request, which could still show the
+    state from before it.
+
+    `on_error` is called with the new status whenever a node's error bits
+    change, including when they are cleared (see odrive_error_codes.decode_error
+    to decode them). Like the waits' wake-ups, it runs in the notifier's
+    context.
+    """
+    def __init__(self, dispatcher: CanDispatcher, node_ids, on_error=None):
+        self.dispatcher = dispatcher
+        self.on_error = on_error
+        self._status = {node_id: AxisStatus(node_id) for node_id in node_ids}
+        self._async_waiters = set() # (loop, asyncio.Event)
+        for node_id in self._status:
+            dispatcher.subscribe(node_id, HEARTBEAT_CMD, self._on_heartbeat)
+
+    def stop(self):
+        for node_id in self._status:
+            self.dispatcher.unsubscribe(node_id, HEARTBEAT_CMD, self._on_heartbeat)
+
+    def _on_heartbeat(self, msg):
+        node_id = msg.arbitration_id >> 5
+        if instruments.enabled:
+            instruments.mark("heartbeat_interval", node_id)
+        error, state, procedure_result, traj_done = HEARTBEAT.unpack_from(msg.data)
+        previous = self._status[node_id]
+        status = self._status[node_id] = AxisStatus(node_id, state, error, procedure_result,
+                                                    bool(traj_done), time.monotonic())
+        if error != previous.error and self.on_error is not None:
+            self.on_error(status)
+        for loop, event in tuple(self._async_waiters):
+            loop.call_soon_threadsafe(event.set)
+
+    def status(self, node_id: int) -> AxisStatus:
+        return self._status[node_id]
+
+    def statuses(self) -> list:
+        return list(self._status.values())
+
+    def silent(self, timeout: float) -> list:
+        """Returns the node ids that sent no heartbeat in the last `timeout` seconds."""
+        now = time.monotonic()
+        return [status.node_id for status in self._status.values()
+                if status.last_seen is None or now - status.last_seen > timeout]
+
+    def lagging(self, node_ids, predicate, since: float = None) -> list:
+        """Returns the node ids whose cached status doesn't satisfy `predicate` (yet)."""
+        lagging = []
+        for node_id in node_ids:
+            status = self._status[node_id]
+            if status.last_seen is None or (since is not None and status.last_seen < since) or not predicate(status):
+                lagging.append(node_id)
+        return lagging
+
+    async def wait_until_async(self, node_ids, predicate, timeout: float, since: float = None) -> list:
+        """Waits until every node satisfies `predicate`, returns the node ids that didn't."""
+        lagging = self.lagging(node_ids, predicate, since)
+        if not lagging:
+            return lagging
+        loop, changed = asyncio.get_running_loop(), asyncio.Event()
+        self._async_waiters.add((loop, changed))
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                changed.clear()
+                lagging = self.lagging(node_ids, predicate, since)
+                remaining = deadline - time.monotonic()
+                if not lagging or remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._async_waiters.discard((loop, changed))
+        return lagging
+
+    async def wait_for_state_async(self, node_ids, state: int, timeout: float, since: float = None) -> list:
+        return await self.wait_until_async(node_ids, lambda status: status.state == state, timeout, since)
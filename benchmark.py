@@ -0,0 +1,191 @@
+"""
+Performance benchmarks run against simulated ODrives (see odrive_sim.py), so
+changes to the configure and teleop paths can be measured and compared
+between commits without hardware.
+
+Usage:
+    python benchmark.py --output before.json
+    python benchmark.py --compare before.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import statistics
+import threading
+import time
+
+import can
+
+from can_simple_utils import CanDispatcher, CanSimpleNode, NodeGroup, SetpointPublisher, TX_SDO_CMD
+from config_compiler import ConfigCompiler
+import configure
+from configure import EndpointAccess
+from control_loop import RateLoop
+from node_registry import NodeRegistry
+from odrive_sim import ODriveSimulator
+
+_SDO_ENDPOINT = "axis0.controller.config.vel_limit"
+
+
+async def bench_configure(channel: str, node_ids, parallel: int, window: int, calibrate: bool) -> dict:
+    """Configures every node from scratch with the track role and returns the elapsed time."""
+    compiler = ConfigCompiler.from_file()
+    with NodeRegistry.from_args('virtual', channel, 250000) as registry:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            failed = await configure.configure_all([(node_id, "track") for node_id in node_ids], registry, compiler,
+                                                   True, calibrate, parallel, window)
+        elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "per_node_seconds": elapsed / len(node_ids), "failed": failed}
+
+
+async def bench_sdo_rtt(channel: str, node_id: int, samples: int) -> dict:
+    """Times single SDO reads, one at a time."""
+    with can.interface.Bus(channel, interface='virtual') as bus:
+        with CanSimpleNode(bus, node_id) as node:
+            odrv = EndpointAccess(node)
+            await odrv.version_check()
+            rtts = []
+            for _ in range(samples):
+                start = time.perf_counter()
+                await odrv.read_many([_SDO_ENDPOINT], window=1)
+                rtts.append(time.perf_counter() - start)
+    rtts.sort()
+    return {
+        "mean_ms": statistics.fmean(rtts) * 1e3,
+        "p50_ms": rtts[len(rtts) // 2] * 1e3,
+        "p99_ms": rtts[min(len(rtts) - 1, math.ceil(len(rtts) * 0.99) - 1)] * 1e3,
+    }
+
+
+async def bench_receive_path(frames: int, nodes: int) -> dict:
+    """
+    Feeds frames straight into a dispatcher serving `nodes` CanSimpleNodes:
+    half of them are TxSdo replies for a subscribed node, the rest traffic
+    nobody listens to.
+    """
+    dispatcher = CanDispatcher()
+    bus = can.interface.Bus("bench_receive_path", interface='virtual')
+    node_list = [CanSimpleNode(bus, node_id, dispatcher) for node_id in range(1, nodes + 1)]
+    for node in node_list:
+        node.__enter__()
+    messages = [
+        can.Message(arbitration_id=(i % nodes + 1) << 5 | (TX_SDO_CMD if i % 2 else 0x09),
+                    data=bytes(8), is_extended_id=False)
+        for i in range(1024)
+    ]
+    start = time.perf_counter()
+    for i in range(frames):
+        dispatcher.on_message_received(messages[i & 1023])
+        if i & 1023 == 1023:
+            for node in node_list:
+                node.flush_rx()
+    elapsed = time.perf_counter() - start
+    for node in node_list:
+        node.__exit__(None, None, None)
+    bus.shutdown()
+    return {"frames_per_second": frames / elapsed}
+
+
+async def bench_control_loop(channel: str, node_ids, rate: float, seconds: float, report_rate: float) -> dict:
+    """
+    Runs a teleop-like loop the way run.py does, on the event loop and woken
+    up early by controller reports, here posted by a thread at `report_rate`
+    (0 for none). Every tick sends a slowly varying setpoint to every node
+    as one group.
+    """
+    event_loop = asyncio.get_running_loop()
+    updated = asyncio.Event()
+    stop = threading.Event()
+
+    def controller():
+        while not stop.wait(1 / report_rate):
+            event_loop.call_soon_threadsafe(updated.set)
+
+    reporter = threading.Thread(target=controller, daemon=True)
+    if report_rate > 0:
+        reporter.start()
+    try:
+        with can.interface.Bus(channel, interface='virtual') as bus:
+            setpoint = SetpointPublisher(NodeGroup([CanSimpleNode(bus, node_id) for node_id in node_ids]))
+            loop = RateLoop(rate)
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                await loop.wait_async(updated)
+                vel = round(10 * math.sin(time.monotonic()), 1)
+                setpoint.set_velocity(vel)
+    finally:
+        stop.set()
+    stats = loop.stats()
+    return {
+        "rate_hz": rate,
+        "period_ms": stats.period * 1e3,
+        "jitter_ms": stats.jitter * 1e3,
+        "overruns": stats.overruns,
+        "max_latency_ms": stats.max_latency * 1e3,
+        "setpoints_sent": setpoint.sent * len(node_ids),
+        "setpoints_suppressed": setpoint.suppressed * len(node_ids),
+    }
+
+
+async def run(args) -> dict:
+    node_ids = list(range(21, 21 + args.nodes))
+    results = {}
+    with ODriveSimulator(args.channel, node_ids, latency=args.latency, drop_rate=args.drop_rate,
+                         calibration_time=args.calibration_time, seed=0):
+        results["configure_one"] = await bench_configure(args.channel, node_ids[:1], 1, args.sdo_window, args.calibrate)
+        results["configure_all"] = await bench_configure(args.channel, node_ids, args.parallel, args.sdo_window, args.calibrate)
+        results["sdo_rtt"] = await bench_sdo_rtt(args.channel, node_ids[0], args.samples)
+        results["receive_path"] = await bench_receive_path(args.frames, args.nodes)
+        results["control_loop"] = await bench_control_loop(args.channel, node_ids, args.rate, args.seconds, args.report_rate)
+    return results
+
+
+def print_results(results: dict, baseline: dict = None):
+    for name, values in results.items():
+        print(f"{name}:")
+        for key, value in values.items():
+            line = f"  {key}: {value:.4g}" if isinstance(value, float) else f"  {key}: {value}"
+            before = (baseline or {}).get(name, {}).get(key)
+            if isinstance(value, float) and isinstance(before, (int, float)) and before:
+                line += f" (was {before:.4g}, {(value - before) / before * 100:+.1f}%)"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark configure and teleop paths against simulated ODrives.')
+    parser.add_argument('-n', '--nodes', type=int, default=8, help='Number of simulated nodes. Default is 8.')
+    parser.add_argument('-c', '--channel', type=str, default='benchmark', help='Virtual bus channel name. Default is benchmark.')
+    parser.add_argument('--latency', type=float, default=0.0005, help='Simulated reply latency in seconds. Default is 0.0005.')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Probability that a request is lost. Default is 0.')
+    parser.add_argument('--calibrate', action='store_true', help='Include calibration in the configure benchmark.')
+    parser.add_argument('--calibration-time', type=float, default=0.5, help='Simulated calibration time in seconds. Default is 0.5.')
+    parser.add_argument('-p', '--parallel', type=int, default=8, help='Nodes configured concurrently. Default is 8.')
+    parser.add_argument('-w', '--sdo-window', type=int, default=8, help='SDO writes in flight per node. Default is 8.')
+    parser.add_argument('--samples', type=int, default=200, help='SDO round trips to time. Default is 200.')
+    parser.add_argument('--frames', type=int, default=200000, help='Frames pushed through the receive path. Default is 200000.')
+    parser.add_argument('-r', '--rate', type=float, default=100, help='Control loop rate in Hz. Default is 100.')
+    parser.add_argument('--report-rate', type=float, default=125, help='Simulated controller reports per second waking the control loop, 0 for none. Default is 125.')
+    parser.add_argument('--seconds', type=float, default=3.0, help='Control loop duration in seconds. Default is 3.')
+    parser.add_argument('-o', '--output', type=str, help='Write the results to this JSON file.')
+    parser.add_argument('--compare', type=str, help='JSON results of an earlier run to compare against.')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Runs full calibration sequences on several drives at once without
+overloading a shared power supply.
+
+Each calibration is admitted only while the worst-case DC current of all
+running calibrations fits the supply budget; the others queue. The
+worst case is bounded from the config alone:
+
+- the resistance calibration fails for a phase resistance above
+  resistance_calib_max_voltage / calibration_current, so that is the
+  largest motor resistance a calibrating drive can be driving,
+- the highest phase current applied is the larger of calibration_current
+  and calibration_lockin.current, dissipating at most 1.5 * I^2 * R,
+- that power is drawn from the bus at no less than the undervoltage trip
+  level, and never above the drive's own dc_max_positive_current.
+"""
+import asyncio
+import contextlib
+import time
+
+from axis_state import AxisStateTracker, AxisStatus, FULL_CALIBRATION_SEQUENCE, IDLE, PROCEDURE_BUSY, PROCEDURE_RESULTS, PROCEDURE_SUCCESS
+from can_simple_utils import CanSimpleNode
+from odrive_error_codes import decode_error
+
+CALIBRATION_TIMEOUT = 60 # [s]
+START_TIMEOUT = 1.0 # [s] per attempt
+START_ATTEMPTS = 5  # a drive that was just told to save and reboot ignores requests for a moment
+
+
+def calibration_draw(config: dict) -> float:
+    """
+    Returns the worst-case DC current [A] of a drive calibrating with
+    `config`, or None when the config lacks the values to bound it.
+    """
+    try:
+        calibration_current = config['axis0.config.motor.calibration_current']
+        max_voltage = config['axis0.config.motor.resistance_calib_max_voltage']
+        min_bus_voltage = config['config.dc_bus_undervoltage_trip_level']
+    except KeyError:
+        return None
+    current = max(calibration_current, config.get('axis0.config.calibration_lockin.current', 0))
+    draw = 1.5 * current ** 2 * (max_voltage / calibration_current) / min_bus_voltage
+    limit = config.get('config.dc_max_positive_current')
+    return min(draw, limit) if limit else draw
+
+
+class CalibrationScheduler():
+    """
+    Admits calibrations while their combined draw fits `supply_current`
+    [A]. A calibration whose draw is unknown or larger than the whole budget
+    runs alone. The outcome of every calibration is kept in `results`.
+    """
+    def __init__(self, supply_current: float):
+        self.supply_current = supply_current
+        self.in_use = 0.0
+        self.running = 0
+        self.results = {} # node id -> AxisStatus at the end of the calibration
+        self._changed = asyncio.Condition()
+
+    def concurrency(self, draw: float) -> int:
+        """Returns how many calibrations of `draw` run at once."""
+        return 1 if not draw else max(1, int(self.supply_current // draw))
+
+    @contextlib.asynccontextmanager
+    async def slot(self, draw: float):
+        draw = draw or self.supply_current
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.running == 0 or self.in_use + draw <= self.supply_current)
+            self.in_use += draw
+            self.running += 1
+        try:
+            yield
+        finally:
+            async with self._changed:
+                self.in_use -= draw
+                self.running -= 1
+                self._changed.notify_all()
+
+    def summary(self) -> list:
+        """Returns one line per calibrated node."""
+        lines = []
+        for node_id, status in sorted(self.results.items()):
+            result = PROCEDURE_RESULTS.get(status.procedure_result, status.procedure_result)
+            errors = f", errors {decode_error(status.error).names()}" if status.error else ""
+            lines.append(f"node {node_id}: {result}{errors}")
+        return lines
+
+
+def _started(status: AxisStatus) -> bool:
+    return status.state != IDLE or status.procedure_result == PROCEDURE_BUSY
+
+def _finished(status: AxisStatus) -> bool:
+    # procedure_result stays busy until the whole sequence is over
+    return status.state == IDLE and status.procedure_result != PROCEDURE_BUSY
+
+
+async def calibrate(node: CanSimpleNode, scheduler: CalibrationScheduler, draw: float, log=print) -> AxisStatus:
+    """
+    Runs the full calibration sequence once `scheduler` has room for `draw`
+    and returns the node's status at the end. Raises if it doesn't start,
+    doesn't finish within CALIBRATION_TIMEOUT or doesn't succeed.
+    """
+    node_id = node.node_id
+    async with scheduler.slot(draw):
+        # Heartbeats come through the shared dispatcher, reading the bus
+        # directly here would steal frames from the other nodes.
+        tracker = AxisStateTracker(node.dispatcher, [node_id])
+        try:
+            for attempt in range(START_ATTEMPTS):
+                requested = time.monotonic()
+                node.set_state_msg(FULL_CALIBRATION_SEQUENCE)
+                if not await tracker.wait_until_async([node_id], _started, START_TIMEOUT, since=requested):
+                    break
+            else:
+                raise Exception(f"calibration did not start after {START_ATTEMPTS} requests")
+            log("calibrating...")
+            lagging = await tracker.wait_until_async([node_id], _finished, CALIBRATION_TIMEOUT, since=requested)
+            status = tracker.status(node_id)
+        finally:
+            tracker.stop()
+
+    if lagging:
+        raise Exception(f"calibration did not finish within {CALIBRATION_TIMEOUT} s")
+    scheduler.results[node_id] = status
+    if status.procedure_result != PROCEDURE_SUCCESS:
+        errors = f" ({decode_error(status.error).names()})" if status.error else ""
+        raise Exception(f"calibration failed: {PROCEDURE_RESULTS.get(status.procedure_result, status.procedure_result)}{errors}")
+    return status
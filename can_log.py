@@ -0,0 +1,259 @@
+"""
+Binary CAN session recorder and the tool to search, decode and replay its
+recordings.
+
+A recording is a 24 byte header followed by fixed-size 24 byte records:
+
+    float64 timestamp, uint32 arbitration id, uint8 dlc, uint8 flags,
+    2 bytes padding, 8 bytes data
+
+Fixed records keep an hour of traffic at a few hundred frames/s in the tens
+of MB, and let the whole file be memory-mapped as a NumPy array for
+filtering without parsing anything.
+
+Usage:
+    python can_log.py info session.canlog
+    python can_log.py dump session.canlog --node 21 --cmd 0x05 --fw 0.6.10
+    python can_log.py replay session.canlog -i socketcan -c vcan0 --speed 4
+"""
+import argparse
+import queue
+import struct
+import threading
+import time
+
+import can
+import numpy as np
+
+from telemetry import MESSAGES
+
+_MAGIC = b'ODCANREC'
+_VERSION = 1
+_HEADER = struct.Struct('<8sII8x')
+_RECORD = struct.Struct('<dIBB2x8s')
+
+FLAG_RX = 0x01
+FLAG_EXTENDED = 0x02
+FLAG_REMOTE = 0x04
+FLAG_ERROR = 0x08
+
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('arbitration_id', '<u4'),
+    ('dlc', 'u1'),
+    ('flags', 'u1'),
+    ('pad', 'V2'),
+    ('data', 'u1', (8,)),
+])
+assert RECORD_DTYPE.itemsize == _RECORD.size == _HEADER.size
+
+
+class CanRecorder(can.Listener):
+    """
+    Appends every frame the notifier delivers to a recording.
+
+    Frames are packed into batches of `batch_records` in the notifier's
+    context and handed to a writer thread, so the file system never blocks
+    the receive path. At most `max_pending` batches wait for the writer.
+    Past that, batches are dropped and counted in `dropped` rather than
+    stalling the caller. A partial batch is written after `flush_interval`
+    seconds.
+    """
+    def __init__(self, path: str, batch_records: int = 256, max_pending: int = 64, flush_interval: float = 1.0):
+        self.path = path
+        self.recorded = 0
+        self.dropped = 0
+        self._batch_bytes = batch_records * _RECORD.size
+        self._batch = bytearray()
+        self._lock = threading.Lock()
+        self._pending = queue.Queue(max_pending)
+        self._flush_interval = flush_interval
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(_MAGIC, _VERSION, _RECORD.size))
+        self._writer = threading.Thread(target=self._write_batches, daemon=True)
+        self._writer.start()
+
+    def on_message_received(self, msg: can.Message):
+        flags = ((FLAG_RX if msg.is_rx else 0) | (FLAG_EXTENDED if msg.is_extended_id else 0)
+                 | (FLAG_REMOTE if msg.is_remote_frame else 0) | (FLAG_ERROR if msg.is_error_frame else 0))
+        record = _RECORD.pack(msg.timestamp, msg.arbitration_id, msg.dlc, flags, bytes(msg.data))
+        with self._lock:
+            self._batch += record
+            if len(self._batch) < self._batch_bytes:
+                return
+            batch, self._batch = self._batch, bytearray()
+        self._submit(batch)
+
+    def _take_batch(self):
+        with self._lock:
+            batch, self._batch = self._batch, bytearray()
+        return batch
+
+    def _submit(self, batch: bytearray):
+        try:
+            self._pending.put_nowait(batch)
+            self.recorded += len(batch) // _RECORD.size
+        except queue.Full:
+            self.dropped += len(batch) // _RECORD.size
+
+    def _write_batches(self):
+        while True:
+            try:
+                batch = self._pending.get(timeout=self._flush_interval)
+            except queue.Empty:
+                batch = self._take_batch()
+                self.recorded += len(batch) // _RECORD.size
+            if batch is None:
+                break
+            if batch:
+                self._file.write(batch)
+                self._file.flush()
+
+    def stop(self):
+        if self._file.closed: # already stopped by the notifier of another bus
+            return
+        batch = self._take_batch()
+        self._pending.put(batch)
+        self.recorded += len(batch) // _RECORD.size
+        self._pending.put(None)
+        self._writer.join()
+        self._file.close()
+
+
+def open_log(path: str) -> np.ndarray:
+    """Memory-maps a recording as an array of RECORD_DTYPE."""
+    with open(path, 'rb') as f:
+        magic, version, record_size = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != _MAGIC or version != _VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path} is not a version {_VERSION} CAN recording")
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=_HEADER.size)
+
+
+def select(records: np.ndarray, node_id: int = None, cmd_id: int = None, start: float = None, end: float = None) -> np.ndarray:
+    """
+    Returns the records matching every given criterion. `start` and `end`
+    are seconds from the first record.
+    """
+    mask = np.ones(len(records), dtype=bool)
+    if node_id is not None or cmd_id is not None:
+        mask &= (records['flags'] & FLAG_EXTENDED) == 0
+    if node_id is not None:
+        mask &= (records['arbitration_id'] >> 5) == node_id
+    if cmd_id is not None:
+        mask &= (records['arbitration_id'] & 0x1F) == cmd_id
+    if len(records) and (start is not None or end is not None):
+        t = records['timestamp'] - records['timestamp'][0]
+        if start is not None:
+            mask &= t >= start
+        if end is not None:
+            mask &= t <= end
+    return records[mask]
+
+
+def describe(record, endpoints_by_id: dict = None) -> str:
+    """Decodes a record into a one line description."""
+    node_id = int(record['arbitration_id']) >> 5
+    cmd_id = int(record['arbitration_id']) & 0x1F
+    data = record['data'].tobytes()[:record['dlc']]
+    direction = "rx" if record['flags'] & FLAG_RX else "tx"
+    prefix = f"{record['timestamp']:.6f} {direction} node {node_id:2d} cmd 0x{cmd_id:02x}"
+
+    if cmd_id in (0x04, 0x05) and len(data) >= 4:
+        opcode, endpoint_id, _ = struct.unpack_from('<BHB', data)
+        endpoint = endpoints_by_id.get(endpoint_id) if endpoints_by_id else None
+        name = endpoint.path if endpoint else f"endpoint {endpoint_id}"
+        value = ""
+        if endpoint and len(data) >= endpoint.sdo.size:
+            value = f" = {endpoint.sdo.unpack_from(data)[3]}"
+        elif len(data) > 4:
+            value = f" = {data[4:].hex()}"
+        if cmd_id == 0x05:
+            return f"{prefix} TxSdo {name}{value}"
+        return f"{prefix} RxSdo {'write' if opcode else 'read'} {name}{value if opcode else ''}"
+
+    if cmd_id in MESSAGES:
+        name, payload, fields = MESSAGES[cmd_id]
+        if len(data) >= payload.size:
+            values = ", ".join(f"{field}={value:.4g}" for field, value in zip(fields, payload.unpack_from(data)))
+            return f"{prefix} {name} {values}"
+
+    return f"{prefix} {data.hex()}"
+
+
+def replay(records: np.ndarray, bus: can.BusABC, speed: float = 1.0):
+    """
+    Sends `records` on `bus`, keeping their relative timing divided by
+    `speed`. A speed of 0 sends them as fast as possible.
+    """
+    if not len(records):
+        return
+    first = records['timestamp'][0]
+    start = time.monotonic()
+    for record in records:
+        if speed > 0:
+            delay = (record['timestamp'] - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        flags = int(record['flags'])
+        bus.send(can.Message(
+            arbitration_id=int(record['arbitration_id']),
+            data=record['data'].tobytes()[:record['dlc']],
+            is_extended_id=bool(flags & FLAG_EXTENDED),
+            is_remote_frame=bool(flags & FLAG_REMOTE),
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect, decode and replay CAN recordings.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_selection(subparser):
+        subparser.add_argument('file', type=str, help='Recording to read.')
+        subparser.add_argument('-n', '--node', type=int, help='Only frames of this node id.')
+        subparser.add_argument('--cmd', type=lambda x: int(x, 0), help='Only frames of this command id (e.g. 0x05).')
+        subparser.add_argument('--start', type=float, help='Skip frames before this many seconds into the recording.')
+        subparser.add_argument('--end', type=float, help='Skip frames after this many seconds into the recording.')
+
+    info = subparsers.add_parser('info', help='Print a summary of the recording.')
+    add_selection(info)
+
+    dump = subparsers.add_parser('dump', help='Print decoded frames.')
+    add_selection(dump)
+    dump.add_argument('--fw', type=str, help='Firmware version used to name and decode SDO endpoints (e.g. 0.6.10).')
+
+    play = subparsers.add_parser('replay', help='Send the recording on a bus.')
+    add_selection(play)
+    # A virtual bus only exists inside one process, so from here nobody would
+    # receive the frames; use replay() to feed an in-process virtual bus.
+    play.add_argument('-i', '--interface', type=str, default='socketcan', help='Interface type (e.g., socketcan, slcan). Default is socketcan.')
+    play.add_argument('-c', '--channel', type=str, default='vcan0', help='Channel to replay on. Default is vcan0.')
+    play.add_argument('-b', '--bitrate', type=int, default=250000, help='Bitrate for CAN bus. Default is 250000.')
+    play.add_argument('-s', '--speed', type=float, default=1.0, help='Replay speed, 0 for as fast as possible. Default is 1.')
+    args = parser.parse_args()
+
+    records = select(open_log(args.file), args.node, args.cmd, args.start, args.end)
+
+    if args.command == 'info':
+        print(f"{len(records)} frames")
+        if len(records):
+            print(f"{records['timestamp'][-1] - records['timestamp'][0]:.3f} s")
+            standard = records[(records['flags'] & FLAG_EXTENDED) == 0]
+            ids, counts = np.unique(standard['arbitration_id'], return_counts=True)
+            for arbitration_id, count in zip(ids, counts):
+                print(f"  node {arbitration_id >> 5:2d} cmd 0x{arbitration_id & 0x1F:02x}: {count}")
+
+    elif args.command == 'dump':
+        endpoints_by_id = None
+        if args.fw:
+            from endpoint_table import load_endpoint_table
+            endpoints_by_id = {endpoint.id: endpoint for endpoint in load_endpoint_table(args.fw)}
+        for record in records:
+            print(describe(record, endpoints_by_id))
+
+    elif args.command == 'replay':
+        with can.interface.Bus(args.channel, bustype=args.interface, bitrate=args.bitrate) as bus:
+            replay(records, bus, args.speed)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,17 @@
 # 100% from https://github.com/odriverobotics/ODriveResources/blob/master/examples/can_simple_utils.py
+from array import array
 import asyncio
 import can
 import struct
+import time
 
+from instrumentation import instruments
 from odrive_error_codes import get_error_description
 
+HEARTBEAT_CMD = 0x01
 ADDRESS_CMD = 0x06
 SET_AXIS_STATE_CMD = 0x07
+SET_INPUT_VEL_CMD = 0x0d
 REBOOT_CMD = 0x16
 CLEAR_ERRORS_CMD = 0x18
 
@@ -14,41 +19,151 @@ REBOOT_ACTION_REBOOT = 0
 REBOOT_ACTION_SAVE = 1
 REBOOT_ACTION_ERASE = 2
 
+GET_VERSION_CMD = 0x00
+TX_SDO_CMD = 0x05
+
+# Names the instrumentation counts frames under
+CMD_NAMES = {
+    GET_VERSION_CMD: "get_version", HEARTBEAT_CMD: "heartbeat", 0x04: "rx_sdo", TX_SDO_CMD: "tx_sdo",
+    SET_AXIS_STATE_CMD: "set_axis_state", 0x0c: "set_input_pos", SET_INPUT_VEL_CMD: "set_input_vel",
+    REBOOT_CMD: "reboot", CLEAR_ERRORS_CMD: "clear_errors",
+}
+
+# Acceptance filter that matches no CANSimple frame. An empty filter list
+# would make python-can accept everything instead.
+_REJECT_ALL_FILTERS = [{"can_id": 0, "can_mask": 0x1FFFFFFF, "extended": True}]
+
+class CanDispatcher(can.Listener):
+    """
+    Bus-level receive path shared by every node on a bus. Routes each frame
+    to the callbacks subscribed to its (node id, command id) and drops
+    frames nobody subscribed to.
+
+    When given the bus, the bus acceptance filters are kept in sync with the
+    subscriptions, so on socketcan the kernel drops unsubscribed frames
+    before they ever wake up the process.
+
+    Callbacks run in the notifier's context: the event loop when the
+    notifier was given one, its receive thread otherwise.
+    """
+    def __init__(self, bus: can.BusABC = None):
+        self.bus = bus
+        self._subscribers = {} # arbitration id -> tuple of callbacks
+        self._accept_all = False
+        self._update_filters()
+
+    def set_accept_all(self, accept_all: bool):
+        """
+        Lets every frame through the bus filters, for listeners that need to
+        see all traffic (e.g. a recorder). Routing is unchanged.
+        """
+        self._accept_all = accept_all
+        self._update_filters()
+
+    def subscribe(self, node_id: int, cmd_id: int, callback):
+        arbitration_id = node_id << 5 | cmd_id
+        callbacks = self._subscribers.get(arbitration_id, ())
+        # Replace the tuple instead of mutating it so the receive path never
+        # sees a half updated list.
+        self._subscribers[arbitration_id] = callbacks + (callback,)
+        if not callbacks:
+            self._update_filters()
+
+    def unsubscribe(self, node_id: int, cmd_id: int, callback):
+        arbitration_id = node_id << 5 | cmd_id
+        callbacks = tuple(cb for cb in self._subscribers.get(arbitration_id, ()) if cb != callback)
+        if callbacks:
+            self._subscribers[arbitration_id] = callbacks
+        elif self._subscribers.pop(arbitration_id, None) is not None:
+            self._update_filters()
+
+    def filters(self) -> list:
+        """Returns the python-can acceptance filters matching the current subscriptions."""
+        if self._accept_all:
+            return None
+        if not self._subscribers:
+            return _REJECT_ALL_FILTERS
+        return [{"can_id": arbitration_id, "can_mask": 0x7FF, "extended": False} for arbitration_id in sorted(self._subscribers)]
+
+    def _update_filters(self):
+        if self.bus is not None:
+            self.bus.set_filters(self.filters())
+
+    def on_message_received(self, msg: can.Message):
+        # CANSimple only uses 11 bit ids. With receive_own_messages our own
+        # frames come back too, and the only ones on ids anybody subscribes to
+        # are Get_Version requests (empty or remote, unlike the replies).
+        # msg.is_rx can't tell them apart: socketcan clears it for every frame
+        # sent from this host, e.g. by a simulator or replay on vcan.
+        if msg.is_extended_id or msg.is_remote_frame or not msg.dlc:
+            return
+        callbacks = self._subscribers.get(msg.arbitration_id)
+        if callbacks:
+            for callback in callbacks:
+                callback(msg)
+
 class CanSimpleNode():
-    def __init__(self, bus: can.Bus, node_id: int):
+    def __init__(self, bus: can.Bus, node_id: int, dispatcher: CanDispatcher = None,
+                 rx_cmds=(GET_VERSION_CMD, TX_SDO_CMD)):
         self.bus = bus
         self.node_id = node_id
-        self.reader = can.AsyncBufferedReader()
-        self.connected = False
+        # A bus can only have one active notifier, so nodes sharing a bus
+        # must share the caller's dispatcher (and the notifier feeding it).
+        self.dispatcher = dispatcher
+        self._owns_notifier = dispatcher is None
+        self._rx_cmds = rx_cmds
+        self._queues = {} # cmd id -> asyncio.Queue
 
     def __enter__(self):
-        self.notifier = can.Notifier(self.bus, [self.reader], loop=asyncio.get_running_loop())
+        if self._owns_notifier:
+            self.dispatcher = CanDispatcher(self.bus)
+            self.notifier = can.Notifier(self.bus, [self.dispatcher], loop=asyncio.get_running_loop())
+        # Subscribe before anything is sent so no reply can slip through.
+        for cmd_id in self._rx_cmds:
+            self._queue(cmd_id)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.notifier.stop()
-        pass
+        for cmd_id, queue in self._queues.items():
+            self.dispatcher.unsubscribe(self.node_id, cmd_id, queue.put_nowait)
+        self._queues = {}
+        if self._owns_notifier:
+            self.notifier.stop()
+
+    def _queue(self, cmd_id: int) -> asyncio.Queue:
+        queue = self._queues.get(cmd_id)
+        if queue is None:
+            queue = self._queues[cmd_id] = asyncio.Queue()
+            self.dispatcher.subscribe(self.node_id, cmd_id, queue.put_nowait)
+        return queue
 
     def flush_rx(self):
-        while not self.reader.buffer.empty():
-            self.reader.buffer.get_nowait()
+        for queue in self._queues.values():
+            while not queue.empty():
+                queue.get_nowait()
 
-    def await_msg(self, cmd_id: int, timeout=1.0):
-        async def _impl():
-            async for msg in self.reader:
-                if msg.arbitration_id == (self.node_id << 5 | cmd_id):
-                    return msg
-        return asyncio.wait_for(_impl(), timeout)
+    async def await_msg(self, cmd_id: int, timeout=1.0):
+        try:
+            return await asyncio.wait_for(self._queue(cmd_id).get(), timeout)
+        except asyncio.TimeoutError:
+            if instruments.enabled:
+                instruments.count("timeouts", f"{self.node_id}:{CMD_NAMES.get(cmd_id, cmd_id)}")
+            raise
+
+    def send(self, msg: can.Message):
+        self.bus.send(msg)
+        if instruments.enabled:
+            instruments.count("sent", CMD_NAMES.get(msg.arbitration_id & 0x1F, msg.arbitration_id & 0x1F))
 
     def clear_errors_msg(self, identify: bool = False):
-        self.bus.send(can.Message(
+        self.send(can.Message(
             arbitration_id=(self.node_id << 5) | CLEAR_ERRORS_CMD,
             data=b'\x01' if identify else b'\x00',
             is_extended_id=False
         ))
 
     def reboot_msg(self, action: int):
-        self.bus.send(can.Message(
+        self.send(can.Message(
             arbitration_id=(self.node_id << 5) | REBOOT_CMD,
             data=[action],
             is_extended_id=False
@@ -60,35 +175,99 @@ class CanSimpleNode():
         self.clear_errors_msg()
 
     def set_state_msg(self, state: int):
-        self.bus.send(can.Message(
+        self.send(can.Message(
             arbitration_id=(self.node_id << 5 | SET_AXIS_STATE_CMD),
             data=struct.pack('<I', state),
             is_extended_id=False
         ))
-        self.connected = False
-    
-    def wait_state(self, stateWaited: int, msg):
-        if self.connected:
-            return True
-        if msg.arbitration_id == (self.node_id << 5 | 0x01):  # Heartbeat
-            error, state, result, traj_done = struct.unpack('<IBBB', bytes(msg.data[:7]))
-            if state == stateWaited:
-                if error != 0:
-                    self.getErrorDescription(error)  # Check for error codes
-                self.connected = True
-                return True
-        return False
 
     def set_velocity(self, vel:float):
-        self.bus.send(can.Message(
-            arbitration_id=(self.node_id << 5 | 0x0d), # 0x0d: Set_Input_Vel
+        self.send(can.Message(
+            arbitration_id=(self.node_id << 5 | SET_INPUT_VEL_CMD), # 0x0d: Set_Input_Vel
             data=struct.pack('<ff', vel, 0.0), # 1.0: velocity, 0.0: torque feedforward
             is_extended_id=False
         ))
 
     def set_position(self, pos: float, vel_feedforward: float = 0.0):
-        self.bus.send(can.Message(
+        self.send(can.Message(
             arbitration_id=(self.node_id << 5 | 0x0c),  # 0x0c: Set_Input_Pos
             data=struct.pack('<fff', pos, vel_feedforward, 0.0),  # Position, velocity, torque
             is_extended_id=False
         ))
+
+
+_SET_INPUT_VEL = struct.Struct('<ff')
+_SET_AXIS_STATE = struct.Struct('<I')
+
+class NodeGroup():
+    """
+    Nodes that are always commanded together, e.g. the tracks on one side.
+
+    The frames for every member are allocated once and only repacked in
+    place, and all of them are packed before the first one is sent, so a
+    command reaches the members back to back. Members may be on different
+    buses. `signs` gives a per-member factor applied to velocities, e.g. -1
+    for motors mounted mirrored.
+    """
+    def __init__(self, nodes, signs=None):
+        self.nodes = list(nodes)
+        self.buses = [node.bus for node in self.nodes]
+        self.signs = array('d', signs if signs is not None else [1.0] * len(self.nodes))
+        if len(self.signs) != len(self.nodes):
+            raise ValueError("one sign per node is needed")
+        self.arbitration_ids = array('H', [node.node_id << 5 for node in self.nodes])
+        self._velocity_msgs = [can.Message(arbitration_id=arbitration_id | SET_INPUT_VEL_CMD, data=bytearray(8), is_extended_id=False)
+                               for arbitration_id in self.arbitration_ids]
+        self._state_msgs = [can.Message(arbitration_id=arbitration_id | SET_AXIS_STATE_CMD, data=bytearray(4), is_extended_id=False)
+                            for arbitration_id in self.arbitration_ids]
+
+    def _send(self, msgs):
+        for bus, msg in zip(self.buses, msgs):
+            bus.send(msg)
+        if instruments.enabled:
+            instruments.count("sent", CMD_NAMES.get(msgs[0].arbitration_id & 0x1F), len(msgs))
+
+    def set_velocity(self, vel: float):
+        pack_into = _SET_INPUT_VEL.pack_into
+        for msg, sign in zip(self._velocity_msgs, self.signs):
+            pack_into(msg.data, 0, sign * vel, 0.0)
+        self._send(self._velocity_msgs)
+
+    def set_state_msg(self, state: int):
+        for msg in self._state_msgs:
+            _SET_AXIS_STATE.pack_into(msg.data, 0, state)
+        self._send(self._state_msgs)
+
+
+class SetpointPublisher():
+    """
+    Sends velocity setpoints to a node (or a NodeGroup) only when they change
+    by more than `epsilon`. The last setpoint is repeated every `keepalive`
+    seconds, so the ODrive watchdog (axis0.config.enable_watchdog /
+    watchdog_timeout) can be turned on safely as long as `keepalive` is
+    shorter than its timeout.
+    """
+    def __init__(self, node, epsilon: float = 1e-3, keepalive: float = 0.1):
+        self.node = node
+        self.epsilon = epsilon
+        self.keepalive = keepalive
+        self.sent = 0
+        self.suppressed = 0
+        self._last_vel = None
+        self._last_sent = 0.0
+
+    def reset(self):
+        """Forces the next setpoint out, e.g. after the axis changed state."""
+        self._last_vel = None
+
+    def set_velocity(self, vel: float) -> bool:
+        now = time.monotonic()
+        if (self._last_vel is not None and abs(vel - self._last_vel) <= self.epsilon
+                and now - self._last_sent < self.keepalive):
+            self.suppressed += 1
+            return False
+        self.node.set_velocity(vel)
+        self._last_vel = vel
+        self._last_sent = now
+        self.sent += 1
+        return True
@@ -0,0 +1,218 @@
+"""
+Compiles the role profiles of config/profiles.json into write plans.
+
+A role (track, flipper, ...) lists its config files as layers and the node
+ids that get it:
+
+    "track": {
+        "layers": ["config/_track.json", "config/can.json", ...],
+        "node_ids": [11, 22, 23, 13]
+    }
+
+Layers are applied in order, so a later layer overrides an earlier one.
+A compiled role is checked against the endpoint table of a firmware version
+(every path must exist and every value must fit its endpoint's type) and
+turned into the (Endpoint, value) plan written to the drive.
+
+Compiled plans are cached in config/.cache/, one file per role and firmware
+version. A cache file is reused as long as its layers and endpoint table are
+unchanged: the mtime and size are checked first, the content hash only when
+those differ.
+"""
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+import struct
+
+from endpoint_table import Endpoint, endpoint_dir, load_endpoint_table
+
+profiles_file = "config/profiles.json"
+cache_dir = "config/.cache/"
+
+_CACHE_FORMAT = 1
+
+
+@dataclass(frozen=True)
+class Role():
+    name: str
+    layers: tuple   # config files, lowest precedence first
+    node_ids: tuple
+
+
+@dataclass(frozen=True)
+class CompiledConfig():
+    role: str
+    fw_version: str
+    plan: list      # (Endpoint, value) in write order
+    sources: dict   # path -> layer the value came from
+
+    def values(self) -> dict:
+        return {endpoint.path: val for endpoint, val in self.plan}
+
+    def digest(self) -> str:
+        """Hash of what the plan writes, to tell whether a drive got this exact config."""
+        plan = [[endpoint.path, val] for endpoint, val in self.plan]
+        return hashlib.sha256(json.dumps([self.fw_version, plan]).encode()).hexdigest()
+
+
+def load_profiles(path: str = profiles_file) -> dict:
+    """Returns the roles of a profiles file by name."""
+    with open(path, 'r') as f:
+        data = json.load(f)
+    roles = {}
+    for name, role in data['roles'].items():
+        roles[name] = Role(name, tuple(role['layers']), tuple(role.get('node_ids', ())))
+    assigned = {}
+    for role in roles.values():
+        for node_id in role.node_ids:
+            if node_id in assigned:
+                raise ValueError(f"node {node_id} is in both roles {assigned[node_id]} and {role.name}")
+            assigned[node_id] = role.name
+    return roles
+
+
+def _check_value(endpoint: Endpoint, val) -> str:
+    """Returns why `val` can't be written to `endpoint`, or None if it can."""
+    if endpoint.type == 'bool':
+        if not isinstance(val, bool):
+            return f"expected a bool, got {val!r}"
+    elif endpoint.type == 'float':
+        if isinstance(val, bool) or not isinstance(val, (int, float)):
+            return f"expected a number, got {val!r}"
+    elif isinstance(val, bool) or not isinstance(val, int):
+        return f"expected an integer ({endpoint.type}), got {val!r}"
+    try:
+        endpoint.sdo.pack(0, endpoint.id, 0, val)
+    except struct.error as e:
+        return f"{val!r} doesn't fit {endpoint.type}: {e}"
+    return None
+
+
+def _fingerprint(path: str) -> dict:
+    stat = os.stat(path)
+    return {"path": path, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ConfigCompiler():
+    """
+    Compiles the roles of a profiles file, at most once per role and
+    firmware version per process, and reuses the compiled plans cached on
+    disk by earlier runs.
+    """
+    def __init__(self, roles: dict, cache_dir: str = cache_dir):
+        self.roles = roles
+        self.cache_dir = cache_dir
+        self._compiled = {} # (role, fw version) -> CompiledConfig
+
+    @classmethod
+    def from_file(cls, path: str = profiles_file, cache_dir: str = cache_dir):
+        return cls(load_profiles(path), cache_dir)
+
+    def nodes(self, roles=None) -> list:
+        """Returns (node_id, role name) for every node of `roles` (all roles by default)."""
+        return [(node_id, role.name) for role in self.roles.values()
+                if roles is None or role.name in roles for node_id in role.node_ids]
+
+    def merge(self, role_name: str):
+        """Returns the merged values of a role and the layer each one came from."""
+        values = {}
+        sources = {}
+        for layer in self.roles[role_name].layers:
+            with open(layer, 'r') as f:
+                for path, val in json.load(f).items():
+                    values[path] = val
+                    sources[path] = layer
+        return values, sources
+
+    def compile(self, role_name: str, fw_version: str) -> CompiledConfig:
+        """
+        Returns the write plan of a role for a firmware version. Raises a
+        ValueError listing every unknown path and badly typed value, with
+        the layer it came from.
+        """
+        key = (role_name, fw_version)
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            compiled = self._compiled[key] = self._load_cached(role_name, fw_version) or self._compile(role_name, fw_version)
+        return compiled
+
+    def _inputs(self, role_name: str, fw_version: str) -> list:
+        return list(self.roles[role_name].layers) + [endpoint_dir + fw_version + '.json']
+
+    def _cache_path(self, role_name: str, fw_version: str) -> str:
+        return os.path.join(self.cache_dir, f"{role_name}-{fw_version}.json")
+
+    def _compile(self, role_name: str, fw_version: str) -> CompiledConfig:
+        endpoints = load_endpoint_table(fw_version)
+        values, sources = self.merge(role_name)
+
+        plan = []
+        problems = []
+        for path, val in values.items():
+            endpoint = endpoints.endpoints.get(path)
+            problem = "unknown endpoint" if endpoint is None else _check_value(endpoint, val)
+            if problem:
+                problems.append(f"{path} ({sources[path]}): {problem}")
+            else:
+                plan.append((endpoint, val))
+        if problems:
+            raise ValueError(f"invalid {role_name} config for firmware {fw_version}:\n  " + "\n  ".join(problems))
+
+        compiled = CompiledConfig(role_name, fw_version, plan, sources)
+        self._store_cached(compiled)
+        return compiled
+
+    def _load_cached(self, role_name: str, fw_version: str) -> CompiledConfig:
+        try:
+            with open(self._cache_path(role_name, fw_version), 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        inputs = self._inputs(role_name, fw_version)
+        if cached.get('format') != _CACHE_FORMAT or [entry['path'] for entry in cached['inputs']] != inputs:
+            return None
+        refreshed = False
+        try:
+            for entry in cached['inputs']:
+                fingerprint = _fingerprint(entry['path'])
+                if fingerprint['mtime_ns'] != entry['mtime_ns'] or fingerprint['size'] != entry['size']:
+                    if _hash(entry['path']) != entry['sha256']:
+                        return None
+                    entry.update(fingerprint) # touched but unchanged
+                    refreshed = True
+        except OSError:
+            return None # let the compile report the missing file
+
+        endpoints = load_endpoint_table(fw_version)
+        compiled = CompiledConfig(role_name, fw_version,
+                                  [(endpoints[path], val) for path, val in cached['plan']], cached['sources'])
+        if refreshed:
+            self._write_cache(role_name, fw_version, cached)
+        return compiled
+
+    def _store_cached(self, compiled: CompiledConfig):
+        inputs = [dict(_fingerprint(path), sha256=_hash(path)) for path in self._inputs(compiled.role, compiled.fw_version)]
+        self._write_cache(compiled.role, compiled.fw_version, {
+            "format": _CACHE_FORMAT,
+            "inputs": inputs,
+            "plan": [[endpoint.path, val] for endpoint, val in compiled.plan],
+            "sources": compiled.sources,
+        })
+
+    def _write_cache(self, role_name: str, fw_version: str, cached: dict):
+        # Written to a temporary file first so a concurrent run never reads half a cache file
+        path = self._cache_path(role_name, fw_version)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(cached, f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"could not write config cache {path}: {e}")
@@ -5,167 +5,461 @@ import can
 from dataclasses import dataclass
 import json
 import math
+import os
 import struct
-from can_simple_utils import CanSimpleNode, REBOOT_ACTION_SAVE # if this import fails, make sure you copy the whole folder from the git repository
+import time
+from axis_state import AxisStateTracker
+from calibration import CalibrationScheduler, calibrate as run_calibration, calibration_draw
+from can_simple_utils import CanSimpleNode, GET_VERSION_CMD, REBOOT_ACTION_SAVE # if this import fails, make sure you copy the whole folder from the git repository
+from config_compiler import ConfigCompiler, profiles_file
+from configure_journal import CALIBRATED, Journal, SAVED, VERSION_CHECKED, WRITTEN, journal_file
+from endpoint_table import Endpoint, EndpointTable, load_endpoint_table
+from instrumentation import instruments
+from node_registry import NodeRegistry, buses_file, cyclic_bits_per_second
+from sdo_transactions import SdoTransactions
 
-endpoint_dir = "flat_endpoints/"
-track_config_file = "config/_track.json"
-flipper_config_file = "config/_flipper.json"
-config_files = ["config/can.json", "config/encoder.json", "config/power_source.json"]
+SNAPSHOT_FORMAT = 1
 
-# tracks_node_ids = [21, 22, 23, 24]
-tracks_node_ids = [11, 22, 23, 13]
-# flipper_node_ids = [11, 12, 13, 14]
-flipper_node_ids = []
-
-IDLE=1
-CALIBRATION=3
-
-_OPCODE_READ = 0x00
-_OPCODE_WRITE = 0x01
-
-# See https://docs.python.org/3/library/struct.html#format-characters
-_FORMAT_LOOKUP = {
-    'bool': '?',
-    'uint8': 'B', 'int8': 'b',
-    'uint16': 'H', 'int16': 'h',
-    'uint32': 'I', 'int32': 'i',
-    'uint64': 'Q', 'int64': 'q',
-    'float': 'f'
-}
-
-_GET_VERSION_CMD = 0x00 # Get_Version
-_RX_SDO = 0x04 # RxSdo
-_TX_SDO = 0x05 # TxSdo
+REBOOT_TIMEOUT = 5     # [s] for the heartbeats to come back
+REBOOT_ATTEMPTS = 3    # save requests before giving up on a drive that doesn't go quiet
+HEARTBEAT_PERIOD = 0.1 # [s] when the config doesn't set axis0.config.can.heartbeat_msg_rate_ms
 
 
 @dataclass
 class EndpointAccess():
     node: CanSimpleNode
-    endpoint_data: dict
+    endpoints: EndpointTable = None
+    retries: int = 3
+    sdo: SdoTransactions = None
+
+    def __post_init__(self):
+        if self.sdo is None:
+            self.sdo = SdoTransactions(self.node, retries=self.retries)
 
     async def version_check(self):
         self.node.flush_rx()
 
-        # Send read command
-        self.node.bus.send(can.Message(
-            arbitration_id=(self.node.node_id << 5 | _GET_VERSION_CMD),
-            data=b'',
-            is_extended_id=False
-        ))
-
-        # Await reply
-        msg = await self.node.await_msg(_GET_VERSION_CMD)
+        # Send read command, again if the reply got lost
+        for attempt in range(self.retries + 1):
+            self.node.send(can.Message(
+                arbitration_id=(self.node.node_id << 5 | GET_VERSION_CMD),
+                data=b'',
+                is_extended_id=False
+            ))
+            try:
+                msg = await self.node.await_msg(GET_VERSION_CMD)
+                break
+            except asyncio.TimeoutError:
+                if attempt == self.retries:
+                    raise
 
         _, hw_product_line, hw_version, hw_variant, fw_major, fw_minor, fw_revision, fw_unreleased = struct.unpack('<BBBBBBBB', msg.data)
         hw_version_str = f"{hw_product_line}.{hw_version}.{hw_variant}"
         fw_version_str = f"{fw_major}.{fw_minor}.{fw_revision}"
 
-        with open(endpoint_dir + fw_version_str + '.json', 'r') as f:
-            self.endpoint_data = json.load(f)
+        self.endpoints = load_endpoint_table(fw_version_str)
 
         # If one of these asserts fail, you're probably not using the right flat_endpoints.json file
-        if self.endpoint_data['fw_version'] != fw_version_str:
-            print(f"the file provided in --endpoints-json does not match the firmware version of the ODrive: {self.endpoint_data['fw_version']} != {fw_version_str}")
+        if self.endpoints.fw_version != fw_version_str:
+            print(f"the file provided in --endpoints-json does not match the firmware version of the ODrive: {self.endpoints.fw_version} != {fw_version_str}")
             return False
-        if self.endpoint_data['hw_version'] != hw_version_str:
-            print(f"the file provided in --endpoints-json does not match the firmware version of the ODrive: {self.endpoint_data['hw_version']} != {hw_version_str}")
+        if self.endpoints.hw_version != hw_version_str:
+            print(f"the file provided in --endpoints-json does not match the firmware version of the ODrive: {self.endpoints.hw_version} != {hw_version_str}")
             return False
         return True
 
     async def write_and_verify(self, path: str, val):
-        endpoint_id = self.endpoint_data['endpoints'][path]['id']
-        endpoint_type = self.endpoint_data['endpoints'][path]['type']
-        endpoint_fmt = _FORMAT_LOOKUP[endpoint_type]
+        await self.write_many([(self.endpoints[path], val)], window=1)
 
-        self.node.bus.send(can.Message(
-            arbitration_id=(self.node.node_id << 5 | _RX_SDO),
-            data=struct.pack('<BHB' + endpoint_fmt, _OPCODE_WRITE, endpoint_id, 0, val),
-            is_extended_id=False
-        ))
+    async def write_many(self, plan: list, window: int = 8):
+        """
+        Writes every (Endpoint, value) pair of `plan` (see
+        ConfigCompiler.compile(...).plan) with up to `window` write + read-back
+        pairs in flight. All mismatches are reported together once every entry has
+        been read back, after lost writes were retried.
+        """
+        def verify(endpoint, val, return_value):
+            return _values_match(return_value, endpoint.prune(val))
 
-        self.node.flush_rx()
+        mismatches = []
+        for endpoint, val, return_value in await self.sdo.exchange(plan, True, window, verify):
+            val_pruned = endpoint.prune(val)
+            if not _values_match(return_value, val_pruned):
+                mismatches.append(f"{endpoint.path}: {return_value} != {val_pruned}")
 
-        self.node.bus.send(can.Message(
-            arbitration_id=(self.node.node_id << 5 | _RX_SDO),
-            data=struct.pack('<BHB', _OPCODE_READ, endpoint_id, 0),
-            is_extended_id=False
-        ))
+        if mismatches:
+            raise Exception(f"failed to write {len(mismatches)} variable(s):\n  " + "\n  ".join(mismatches))
 
-        msg = await self.node.await_msg(_TX_SDO)
+    async def read_many(self, paths, window: int = 8) -> dict:
+        """Reads every endpoint of `paths` with up to `window` reads in flight."""
+        plan = [(self.endpoints[path], None) for path in paths]
+        results = await self.sdo.exchange(plan, False, window)
+        return {endpoint.path: return_value for endpoint, _, return_value in results}
 
-        # Unpack and cpmpare reply
-        _, _, _, return_value = struct.unpack_from('<BHB' + endpoint_fmt, msg.data)
-        val_pruned = val if endpoint_type != 'float' else struct.unpack('<f', struct.pack('<f', val))[0]
-        if return_value == val_pruned:
-            pass
-        else:
-            if math.isnan(return_value) != math.isnan(val_pruned):
-                raise Exception(f"failed to write {path}: {return_value} != {val_pruned}")
-
-
-async def restore_config(odrv: EndpointAccess, config: dict):
-    print(f"writing {len(config)} variables...")
-    for k, v in config.items():
-        print(f"  {k} = {v}")
-        await odrv.write_and_verify(k, v)
-
-async def configure(node_id, bus, config, save_config, calibrate):
-    with CanSimpleNode(bus=bus, node_id=node_id) as node:
-        odrv = EndpointAccess(node=node, endpoint_data={})
-        print("Node id:", node_id)
-        print("checking version...")
-        if await odrv.version_check():
-            await restore_config(odrv, config)
-            print()
-            if save_config:
-                print(f"saving configuration...")
-                node.reboot_msg(REBOOT_ACTION_SAVE)
-        if calibrate:
-            odrv.node.set_state_msg(CALIBRATION)
-            print(f"calibrating...")
-            
-            for msg in bus:
-                if odrv.node.wait_state(IDLE, msg):
-                    break
+    async def diff(self, plan: list, window: int = 8) -> list:
+        """Returns the entries of `plan` whose value differs from what the drive currently holds."""
+        current = await self.read_many((endpoint.path for endpoint, _ in plan), window)
+        return [
+            (endpoint, val) for endpoint, val in plan
+            if not _values_match(current[endpoint.path], endpoint.prune(val))
+        ]
+
+
+def _values_match(return_value, val_pruned) -> bool:
+    return return_value == val_pruned or (math.isnan(return_value) and math.isnan(val_pruned))
+
+
+async def _silent_for(tracker: AxisStateTracker, node_id: int, silence: float, timeout: float) -> float:
+    """
+    Waits up to `timeout` for the node to send no heartbeat for `silence`
+    seconds. Returns when the silence started, or None if it never did.
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    while True:
+        now = time.monotonic()
+        last_seen = tracker.status(node_id).last_seen or started
+        if now - last_seen > silence:
+            return last_seen
+        if now >= deadline:
+            return None
+        await asyncio.sleep(silence / 4)
+
+async def save_and_reboot(node: CanSimpleNode, heartbeat_period=HEARTBEAT_PERIOD, attempts=REBOOT_ATTEMPTS, timeout=REBOOT_TIMEOUT):
+    """
+    Saves the configuration to NVM and confirms the drive rebooted: its
+    heartbeats have to stop for longer than `heartbeat_period` and then come
+    back. A drive that keeps sending heartbeats never got the request, which
+    is repeated up to `attempts` times. Raises if the drive doesn't reboot or
+    doesn't come back within `timeout`.
+    """
+    node_id = node.node_id
+    silence = 2.5 * heartbeat_period # a lost or late heartbeat isn't a reboot yet
+    tracker = AxisStateTracker(node.dispatcher, [node_id])
+    try:
+        for attempt in range(attempts):
             node.reboot_msg(REBOOT_ACTION_SAVE)
+            went_silent = await _silent_for(tracker, node_id, silence, silence + 1.0)
+            if went_silent is not None:
+                break
+        else:
+            raise Exception(f"the drive kept sending heartbeats after {attempts} save requests, the configuration isn't saved")
+        if await tracker.wait_until_async([node_id], lambda status: True, timeout, since=went_silent):
+            raise Exception(f"no heartbeat within {timeout} s of the reboot, the configuration may not be saved")
+    finally:
+        tracker.stop()
+
+async def restore_config(odrv: EndpointAccess, plan: list, log=print, window=8, diff_only=False):
+    """
+    Writes the (Endpoint, value) pairs of `plan` (see ConfigCompiler) to the
+    drive and returns the ones that were written. With `diff_only`, the
+    current values are read first and only the entries that differ are
+    written.
+    """
+    if diff_only:
+        log(f"reading {len(plan)} variables...")
+        plan = await odrv.diff(plan, window)
+        if not plan:
+            log("configuration already up to date")
+            return plan
+
+    log(f"writing {len(plan)} variables...")
+    for endpoint, val in plan:
+        log(f"  {endpoint.path} = {val}")
+    await odrv.write_many(plan, window)
+    return plan
+
+async def configure(node_id, registry: NodeRegistry, compiler: ConfigCompiler, role, save_config, calibrate, sdo_window=8, diff_only=False,
+                    journal: Journal = None, scheduler: CalibrationScheduler = None, slot: asyncio.Semaphore = None):
+    """
+    Writes the node's role config and optionally saves and calibrates it,
+    the calibration waiting for room in the power budget of `scheduler`.
+    `slot` (see run_on_nodes) is released for the calibration, so how many
+    drives calibrate at once only depends on the power budget.
+    With a `journal`, the phases already done with the same config on the
+    same drive versions are skipped.
+    """
+    if scheduler is None:
+        scheduler = CalibrationScheduler(0) # one at a time
+
+    def log(*args):
+        print(f"[node {node_id}]", *args)
+
+    def done(phase, digest):
+        return journal is not None and journal.done(node_id, phase, digest)
+
+    def record(phase, digest, versions=(None, None)):
+        if journal is not None:
+            journal.record(node_id, phase, digest, role, *versions)
+
+    with registry.node(node_id) as node:
+        odrv = EndpointAccess(node=node)
+        log("checking version...")
+        if not await odrv.version_check():
+            raise Exception("no endpoint table matches the drive's firmware")
+        versions = (odrv.endpoints.fw_version, odrv.endpoints.hw_version)
+        if journal is not None and journal.versions(node_id) not in (versions, (None, None)):
+            log("drive versions changed since the journal, starting over")
+            journal.forget(node_id)
+        compiled = compiler.compile(role, odrv.endpoints.fw_version)
+        digest = compiled.digest()
+        # Saving another baud rate than the bus runs at would cut the drive off
+        baud_rate = compiled.values().get('can.config.baud_rate')
+        if baud_rate is not None and baud_rate != registry.bitrate(node_id):
+            raise Exception(f"the {role} config sets {baud_rate} bit/s but bus {registry.bus_name(node_id)} runs at {registry.bitrate(node_id)}")
+        record(VERSION_CHECKED, digest, versions)
+        heartbeat_period = compiled.values().get('axis0.config.can.heartbeat_msg_rate_ms', 0) / 1000 or HEARTBEAT_PERIOD
+
+        # A config that isn't saved doesn't survive a reboot, so only a saved
+        # one lets a rerun skip the writes
+        if save_config and done(SAVED, digest) and (not calibrate or done(CALIBRATED, digest)):
+            log("already done according to the journal, skipping")
+            return
+        if done(SAVED, digest):
+            log("configuration already written and saved according to the journal")
+        else:
+            written = await restore_config(odrv, compiled.plan, log, sdo_window, diff_only)
+            record(WRITTEN, digest)
+            if save_config and written:
+                log("saving configuration...")
+                await save_and_reboot(node, heartbeat_period)
+                record(SAVED, digest)
+
+        if calibrate and done(CALIBRATED, digest):
+            log("already calibrated according to the journal")
+        elif calibrate:
+            if slot is not None:
+                slot.release()
+            try:
+                await run_calibration(node, scheduler, calibration_draw(compiled.values()), log)
+            finally:
+                if slot is not None:
+                    await slot.acquire()
+            await save_and_reboot(node, heartbeat_period)
+            record(SAVED, digest)
+            record(CALIBRATED, digest)
+        log("done")
+
+async def run_on_nodes(nodes, job, parallel):
+    """
+    Runs `job(node_id, arg, slot)` for every (node_id, arg) pair of `nodes`
+    with at most `parallel` nodes in flight. `slot` is the semaphore the job
+    holds; a job may release it while it waits for something else, as long
+    as it acquires it again. A node that fails or times out is
+    reported and does not abort the others. Returns the results by node id
+    and the list of node ids that failed.
+    """
+    slots = asyncio.Semaphore(parallel)
+
+    async def run(node_id, arg):
+        async with slots:
+            return await job(node_id, arg, slots)
+
+    results = await asyncio.gather(*(run(node_id, arg) for node_id, arg in nodes), return_exceptions=True)
+
+    succeeded = {}
+    failed = []
+    for (node_id, _), result in zip(nodes, results):
+        if isinstance(result, BaseException):
+            reason = "timed out waiting for a reply" if isinstance(result, asyncio.TimeoutError) and not str(result) else result
+            print(f"[node {node_id}] failed: {reason}")
+            failed.append(node_id)
+        else:
+            succeeded[node_id] = result
+    return succeeded, failed
+
+async def configure_all(nodes, registry: NodeRegistry, compiler: ConfigCompiler, save_config, calibrate, parallel, sdo_window=8, diff_only=False,
+                        journal: Journal = None, supply_current: float = None):
+    """
+    Runs configure() for every (node_id, role) pair with at most `parallel`
+    nodes being written or saved at once. Calibrations don't count against
+    `parallel`, they run concurrently as long as their worst-case draw fits `supply_current` [A], by default the lowest
+    config.dc_max_positive_current of the roles. Returns the list of node
+    ids that failed.
+    """
+    roles = {role: compiler.merge(role)[0] for role in dict.fromkeys(role for _, role in nodes)}
+    node_roles = dict(nodes)
+    for name, node_ids in registry.by_bus(node_roles).items():
+        bitrate = registry.buses[name].bitrate
+        load = sum(cyclic_bits_per_second(roles[node_roles[node_id]]) for node_id in node_ids) / bitrate
+        print(f"bus {name}: {len(node_ids)} node(s), cyclic messages take up to {load * 100:.0f}% of {bitrate / 1000:g} kbit/s")
+
+    if supply_current is None:
+        supply_current = min((config.get('config.dc_max_positive_current', 0) for config in roles.values()), default=0)
+    scheduler = CalibrationScheduler(supply_current)
+    if calibrate:
+        for role, config in roles.items():
+            draw = calibration_draw(config)
+            print(f"calibrating up to {scheduler.concurrency(draw)} {role} node(s) at once "
+                  f"({'unknown' if draw is None else f'{draw:.1f} A'} each, {supply_current:g} A supply)")
+
+    async def job(node_id, role, slot):
+        await configure(node_id, registry, compiler, role, save_config, calibrate, sdo_window, diff_only, journal, scheduler, slot)
+
+    _, failed = await run_on_nodes(nodes, job, parallel)
+    if scheduler.results:
+        print("calibration results:")
+        for line in scheduler.summary():
+            print(f"  {line}")
+    # Nothing left to resume, and a later run must not skip drives that were
+    # replaced or erased in the meantime
+    if journal is not None and not failed:
+        journal.forget(*(node_id for node_id, _ in nodes))
+    return failed
+
+def _is_config_endpoint(endpoint: Endpoint) -> bool:
+    # 64 bit values don't fit in a single TxSdo frame next to the header
+    return 'config' in endpoint.path.split('.') and endpoint.sdo.size <= 8
+
+async def dump(node_id, registry: NodeRegistry, sdo_window=8) -> dict:
+    """Reads every config endpoint of the node and returns them as a snapshot."""
+    def log(*args):
+        print(f"[node {node_id}]", *args)
+
+    with registry.node(node_id) as node:
+        odrv = EndpointAccess(node=node)
+        log("checking version...")
+        if not await odrv.version_check():
+            raise Exception("no endpoint table matches the drive's firmware")
+        paths = [endpoint.path for endpoint in odrv.endpoints if _is_config_endpoint(endpoint)]
+        log(f"reading {len(paths)} variables...")
+        values = await odrv.read_many(paths, sdo_window)
+
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "node_id": node_id,
+        "timestamp": time.time(),
+        "fw_version": odrv.endpoints.fw_version,
+        "hw_version": odrv.endpoints.hw_version,
+        "crc": odrv.endpoints.crc,
+        "values": {path: values[path] for path in paths},
+    }
+
+def diff_snapshot(snapshot: dict, config: dict) -> list:
+    """Returns (path, expected, actual) for every entry of `config` the snapshot doesn't match."""
+    endpoints = load_endpoint_table(snapshot['fw_version'])
+    values = snapshot['values']
+    differences = []
+    for path, val in config.items():
+        actual = values.get(path)
+        if actual is None or not _values_match(actual, endpoints[path].prune(val)):
+            differences.append((path, val, actual))
+    return differences
+
+def diff_snapshots(snapshots: dict) -> dict:
+    """Returns {path: {node_id: value}} for every path whose value isn't the same on all nodes."""
+    differences = {}
+    paths = {path for snapshot in snapshots.values() for path in snapshot['values']}
+    for path in sorted(paths):
+        values = {node_id: snapshot['values'].get(path) for node_id, snapshot in snapshots.items()}
+        first = next(iter(values.values()))
+        if any(val is None or first is None or not _values_match(val, first) for val in values.values()):
+            differences[path] = values
+    return differences
+
+async def dump_all(nodes, registry: NodeRegistry, compiler: ConfigCompiler, directory, parallel, sdo_window=8):
+    """
+    Snapshots every node of `nodes` ((node_id, role) pairs) into
+    `directory`, then prints how each differs from its role's config and how
+    the nodes differ from each other. Returns the list of node ids that failed.
+    """
+    async def job(node_id, role, slot):
+        return await dump(node_id, registry, sdo_window)
+
+    snapshots, failed = await run_on_nodes(nodes, job, parallel)
+
+    os.makedirs(directory, exist_ok=True)
+    for node_id, snapshot in snapshots.items():
+        with open(os.path.join(directory, f"node_{node_id}.json"), 'w') as f:
+            json.dump(snapshot, f, indent=4)
+
+    for node_id, role in nodes:
+        if node_id not in snapshots:
+            continue
+        config = compiler.compile(role, snapshots[node_id]['fw_version']).values()
+        differences = diff_snapshot(snapshots[node_id], config)
+        print(f"[node {node_id}] {len(differences)} value(s) differ from the config files")
+        for path, expected, actual in differences:
+            print(f"  {path}: drive {actual}, config {expected}")
+
+    if len(snapshots) > 1:
+        differences = diff_snapshots(snapshots)
+        print(f"{len(differences)} value(s) differ between nodes")
+        for path, values in differences.items():
+            print(f"  {path}: " + ", ".join(f"{node_id}={val}" for node_id, val in values.items()))
+    return failed
 
 async def main():
     parser = argparse.ArgumentParser(description='Script to configure ODrive over CAN bus.')
     parser.add_argument('-i', '--interface', type=str, default='socketcan', help='Interface type (e.g., socketcan, slcan). Default is socketcan.')
     parser.add_argument('-c', '--channel', type=str, default='can0', help='Channel/path/interface name of the device (e.g., can0, /dev/tty.usbmodem11201).')
     parser.add_argument('-b', '--bitrate', type=int, default=250000, help='Bitrate for CAN bus. Default is 250000.')
+    parser.add_argument("--buses", type=str, metavar="FILE", help=f"Nodes on other buses than -c, e.g. {buses_file}. -i and -b are the defaults of its buses.")
+    parser.add_argument("--bus-load", action='store_true', help="Measure the load of every bus, printed at the end. Lets every frame through the acceptance filters.")
     parser.add_argument("--save-config", action='store_true', help="Save the configuration to NVM and reboot ODrive.")
     parser.add_argument("--calibrate", action='store_true', help="Calibrate the ODrive and save the configuration")
+    parser.add_argument("--supply-current", type=float, help="Current [A] the shared supply can deliver, limits how many drives calibrate at once. Default is config.dc_max_positive_current.")
+    parser.add_argument("-p", "--parallel", type=int, default=1, help="Number of nodes to configure concurrently. Default is 1 (one after another). Calibrations are only limited by --supply-current.")
+    parser.add_argument("-w", "--sdo-window", type=int, default=8, help="Number of endpoint writes kept in flight per node. Default is 8.")
+    parser.add_argument("--diff-only", action='store_true', help="Read the current configuration first and only write (and save) the values that differ.")
+    parser.add_argument("--record", type=str, help="Record all CAN traffic to this file (see can_log.py).")
+    parser.add_argument("--dump", type=str, metavar="DIR", help="Instead of configuring, read every config endpoint of every node into DIR/node_<id>.json and compare them with the config files and each other.")
+    parser.add_argument("--instrument", type=str, metavar="FILE", help="Measure SDO round trips, timeouts and frames sent per command, print a summary at the end and write it to FILE.")
+    parser.add_argument("--journal", type=str, default=journal_file, help=f"Progress journal a failed run is resumed from. Default is {journal_file}.")
+    parser.add_argument("--fresh", action='store_true', help="Ignore the journal and redo every phase of every node.")
+    parser.add_argument("--profiles", type=str, default=profiles_file, help=f"Role profiles listing each role's config files and node ids. Default is {profiles_file}.")
+    parser.add_argument("--role", type=str, action='append', help="Only handle the nodes of this role, can be repeated. Default is every role.")
     args = parser.parse_args()
+    if args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    if args.sdo_window < 1:
+        parser.error("--sdo-window must be at least 1")
     
-    config_list = {}
-    track_config_list = {}
-    flipper_config_list = {}
+    compiler = ConfigCompiler.from_file(args.profiles)
+    unknown_roles = [role for role in args.role or () if role not in compiler.roles]
+    if unknown_roles:
+        parser.error(f"unknown role(s) {', '.join(unknown_roles)}, {args.profiles} has {', '.join(compiler.roles)}")
+    nodes = compiler.nodes(args.role)
 
-    for file in config_files:
-        with open(file, 'r') as f:
-            config_list.update(json.load(f))
+    if args.instrument:
+        instruments.enable()
 
-    with open(track_config_file, 'r') as f:
-        track_config_list.update(json.load(f))
-    track_config_list.update(config_list)
+    journal = Journal(args.journal)
+    if args.fresh:
+        journal.forget(*(node_id for node_id, _ in nodes))
 
-    with open(flipper_config_file, 'r') as f:
-        flipper_config_list.update(json.load(f))
-    flipper_config_list.update(config_list)
+    # The recording gets both sides of each exchange, of every bus
+    registry = NodeRegistry.from_args(args.interface, args.channel, args.bitrate, args.buses,
+                                      receive_own_messages=bool(args.record), measure_load=args.bus_load)
+    recorder = None
+    if args.record:
+        from can_log import CanRecorder
+        recorder = CanRecorder(args.record)
+        registry.set_accept_all(True)
+        registry.add_listener(recorder)
 
     print("opening CAN bus...")
-    with can.interface.Bus(args.channel, bustype=args.interface, bitrate=args.bitrate) as bus:
-        #reader = can.AsyncBufferedReader()
-        #notifier = can.Notifier(bus, [reader], loop=asyncio.get_running_loop())
-        for node_id in tracks_node_ids:
-            await configure(node_id, bus, track_config_list, args.save_config, args.calibrate)
-
-        for node_id in flipper_node_ids:
-            await configure(node_id, bus, flipper_config_list, args.save_config, args.calibrate)
+    with registry:
+        registry.open(node_id for node_id, _ in nodes)
+        if args.dump:
+            failed = await dump_all(nodes, registry, compiler, args.dump, args.parallel, args.sdo_window)
+        else:
+            failed = await configure_all(nodes, registry, compiler, args.save_config, args.calibrate, args.parallel, args.sdo_window, args.diff_only, journal, args.supply_current)
+        for line in registry.load_summary(average=True):
+            print(line)
 
         await asyncio.sleep(0.1) # needed for last message to get through on SLCAN backend
 
+    if recorder is not None: # stopped along with the notifiers
+        print(f"recorded {recorder.recorded} frames to {args.record} ({recorder.dropped} dropped)")
+
+    if instruments.enabled:
+        print(instruments.summary())
+        instruments.dump(args.instrument)
+
+    if failed:
+        print(f"{'dump' if args.dump else 'configuration'} failed for node(s): {', '.join(str(node_id) for node_id in failed)}")
+        raise SystemExit(1)
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,78 @@
+"""
+Progress journal of configure runs, so a run that failed partway can be
+resumed instead of redone from scratch.
+
+Each node's completed phases (version checked, written, saved, calibrated)
+are recorded with the digest of the compiled config they were done with.
+A phase only counts as done for the same digest, so editing the config
+makes the affected nodes go through it again, and only on a drive reporting
+the same firmware and hardware versions, so a replaced or upgraded drive
+starts over. Once a whole run succeeds its nodes are forgotten, so the next
+run configures them again.
+
+The journal is a small JSON file rewritten after every phase:
+
+    {"format": 1, "nodes": {"21": {"role": "track", "fw_version": "0.6.10", "hw_version": "4.4.58",
+        "phases": {"written": {"digest": "...", "at": 1700000000.0}, ...}}}}
+"""
+import json
+import os
+import time
+
+journal_file = ".configure_journal.json"
+
+_JOURNAL_FORMAT = 1
+
+VERSION_CHECKED = "version_checked"
+WRITTEN = "written"
+SAVED = "saved"
+CALIBRATED = "calibrated"
+
+
+class Journal():
+    def __init__(self, path: str = journal_file):
+        self.path = path
+        self.nodes = {} # node id -> {"role", "fw_version", "hw_version", "phases": {phase: {"digest", "at"}}}
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('format') == _JOURNAL_FORMAT:
+                self.nodes = {int(node_id): entry for node_id, entry in data['nodes'].items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"ignoring unreadable journal {path}: {e}")
+
+    def _entry(self, node_id: int) -> dict:
+        return self.nodes.setdefault(node_id, {"role": None, "fw_version": None, "hw_version": None, "phases": {}})
+
+    def versions(self, node_id: int) -> tuple:
+        """Returns the (firmware, hardware) versions the node reported last, or (None, None)."""
+        entry = self.nodes.get(node_id, {})
+        return entry.get('fw_version'), entry.get('hw_version')
+
+    def done(self, node_id: int, phase: str, digest: str) -> bool:
+        record = self.nodes.get(node_id, {}).get('phases', {}).get(phase)
+        return record is not None and record['digest'] == digest
+
+    def record(self, node_id: int, phase: str, digest: str, role: str = None, fw_version: str = None, hw_version: str = None):
+        entry = self._entry(node_id)
+        if role is not None:
+            entry['role'] = role
+        if fw_version is not None:
+            entry['fw_version'] = fw_version
+        if hw_version is not None:
+            entry['hw_version'] = hw_version
+        entry['phases'][phase] = {"digest": digest, "at": time.time()}
+        self._write()
+
+    def forget(self, *node_ids):
+        forgotten = [node_id for node_id in node_ids if self.nodes.pop(node_id, None) is not None]
+        if forgotten:
+            self._write()
+
+    def _write(self):
+        # Written to a temporary file first so an interrupted run never leaves half a journal
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({"format": _JOURNAL_FORMAT, "nodes": self.nodes}, f, indent=4)
+        os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,116 @@
+"""
+Fixed-rate scheduling for the teleop loop.
+
+Deadlines are multiples of the period counted from the first tick, so the
+time spent working in a tick doesn't make the loop drift the way
+sleep(period) after the work does.
+"""
+import asyncio
+from dataclasses import dataclass
+import math
+import time
+
+from instrumentation import instruments
+
+
+@dataclass
+class LoopStats():
+    rate_hz: float
+    ticks: int
+    period: float       # mean measured period [s]
+    jitter: float       # standard deviation of the measured period [s]
+    overruns: int       # ticks whose work ran past the next deadline
+    max_latency: float  # worst wake-up delay after a deadline [s]
+    max_work: float     # longest time spent working in a tick [s]
+
+    def __str__(self):
+        return (f"{self.ticks} ticks at {self.rate_hz:g} Hz: period {self.period * 1e3:.2f} ms, "
+                f"jitter {self.jitter * 1e3:.2f} ms, overruns {self.overruns}, "
+                f"max latency {self.max_latency * 1e3:.2f} ms, max work {self.max_work * 1e3:.2f} ms")
+
+
+class RateLoop():
+    """
+    Await wait_async() at the top of every iteration: it sleeps until the
+    next deadline and records how late the wake-up was. When the work of a
+    tick overruns the next deadline, the missed ticks are dropped instead of
+    being run back to back to catch up.
+
+    The sleep can also be cut short by an event (see `wake`), which runs an
+    extra iteration without moving the schedule.
+    """
+    def __init__(self, rate_hz: float):
+        self.rate_hz = rate_hz
+        self.period = 1.0 / rate_hz
+        self._deadline = None
+        self._tick_start = None
+        self._work_start = None
+        self._woken = False # the last iteration was a wake-up, not a scheduled tick
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._ticks = 0
+        self._period_sum = 0.0
+        self._period_sq_sum = 0.0
+        self._overruns = 0
+        self._max_latency = 0.0
+        self._max_work = 0.0
+
+    async def wait_async(self, wake: asyncio.Event = None) -> bool:
+        """
+        Sleeps until the next deadline. `wake` is an optional event that
+        ends the sleep early when set; it is then cleared and False is
+        returned, unless the deadline was reached by then too. Returns True
+        on a scheduled tick.
+        """
+        now = time.monotonic()
+        deadline = self._next_deadline(now)
+        if deadline > now:
+            if wake is not None:
+                try:
+                    await asyncio.wait_for(wake.wait(), deadline - now)
+                    wake.clear()
+                    if time.monotonic() < deadline:
+                        self._woken = True
+                        self._work_start = time.monotonic()
+                        return False
+                except asyncio.TimeoutError:
+                    pass
+            await asyncio.sleep(max(deadline - time.monotonic(), 0.0))
+        return self._start_tick(deadline)
+
+    def _next_deadline(self, now: float) -> float:
+        if self._deadline is None:
+            return now
+        self._max_work = max(self._max_work, now - self._work_start)
+        if instruments.enabled:
+            instruments.record("loop_work", None, int((now - self._work_start) * 1e9))
+        deadline = self._deadline + self.period
+        if now > deadline:
+            # A wake-up landing just before a deadline isn't the tick's work overrunning
+            if not self._woken:
+                self._overruns += 1
+            deadline += (now - deadline) // self.period * self.period
+        self._woken = False
+        return deadline
+
+    def _start_tick(self, deadline: float) -> bool:
+        self._deadline = deadline
+        start = time.monotonic()
+        self._max_latency = max(self._max_latency, start - self._deadline)
+        if instruments.enabled:
+            instruments.record("loop_latency", None, int((start - self._deadline) * 1e9))
+        if self._tick_start is not None:
+            period = start - self._tick_start
+            self._ticks += 1
+            self._period_sum += period
+            self._period_sq_sum += period * period
+        self._tick_start = self._work_start = start
+        return True
+
+    def stats(self) -> LoopStats:
+        ticks = self._ticks
+        mean = self._period_sum / ticks if ticks else 0.0
+        variance = self._period_sq_sum / ticks - mean * mean if ticks else 0.0
+        return LoopStats(self.rate_hz, ticks, mean, math.sqrt(max(variance, 0.0)),
+                         self._overruns, self._max_latency, self._max_work)
@@ -0,0 +1,68 @@
+"""
+Loads the flat_endpoints/<fw>.json tables once per firmware version and turns
+every endpoint into a compact record with a precompiled SDO struct.
+
+The tables are generated from the ODrive firmware and are the same for every
+node running that firmware, so they are parsed once per process instead of
+once per node.
+"""
+from dataclasses import dataclass
+import functools
+import json
+import struct
+
+endpoint_dir = "flat_endpoints/"
+
+# See https://docs.python.org/3/library/struct.html#format-characters
+_FORMAT_LOOKUP = {
+    'bool': '?',
+    'uint8': 'B', 'int8': 'b',
+    'uint16': 'H', 'int16': 'h',
+    'uint32': 'I', 'int32': 'i',
+    'uint64': 'Q', 'int64': 'q',
+    'float': 'f'
+}
+
+_FLOAT32 = struct.Struct('<f')
+
+
+@dataclass(frozen=True, slots=True)
+class Endpoint():
+    path: str
+    id: int
+    type: str
+    sdo: struct.Struct # '<BHB' header (opcode, endpoint id, reserved) followed by the value
+
+    def prune(self, val):
+        """Returns `val` as the drive will store it (floats are rounded to float32)."""
+        return val if self.type != 'float' else _FLOAT32.unpack(_FLOAT32.pack(val))[0]
+
+
+@dataclass(frozen=True)
+class EndpointTable():
+    fw_version: str
+    hw_version: str
+    crc: int
+    endpoints: dict # path -> Endpoint
+
+    def __getitem__(self, path: str) -> Endpoint:
+        return self.endpoints[path]
+
+    def __iter__(self):
+        return iter(self.endpoints.values())
+
+
+@functools.lru_cache(maxsize=None)
+def load_endpoint_table(fw_version: str) -> EndpointTable:
+    """Loads and caches flat_endpoints/<fw_version>.json."""
+    with open(endpoint_dir + fw_version + '.json', 'r') as f:
+        data = json.load(f)
+
+    endpoints = {}
+    for path, endpoint in data['endpoints'].items():
+        fmt = _FORMAT_LOOKUP.get(endpoint['type'])
+        if fmt is None:
+            continue # functions can't be accessed through RxSdo/TxSdo
+        endpoints[path] = Endpoint(path, endpoint['id'], endpoint['type'], struct.Struct('<BHB' + fmt))
+
+    return EndpointTable(data['fw_version'], data['hw_version'], data['crc'], endpoints)
@@ -0,0 +1,136 @@
+"""
+Opt-in counters and latency histograms for the CAN paths: frames sent per
+command, SDO round trips, timeouts and retries, heartbeat inter-arrival
+times and control loop tick durations.
+
+Instrumentation is off by default. Every call site checks
+`instruments.enabled` first, so when disabled the cost is one attribute
+lookup. Times are time.monotonic_ns() differences recorded into
+histograms with fixed buckets, allocated once per metric.
+
+Usage:
+    from instrumentation import instruments
+    instruments.enable()
+    ...
+    print(instruments.summary())
+    instruments.dump("metrics.json")
+"""
+from array import array
+from bisect import bisect_right
+import json
+import time
+
+# Bucket upper bounds in ns: 4 buckets per octave from 1 us to ~134 s, plus
+# one overflow bucket past the last bound
+_BOUNDS_NS = tuple(int(1000 * 2 ** (i / 4)) for i in range(4 * 27 + 1))
+
+
+class Histogram():
+    """Counts of nanosecond durations in fixed logarithmic buckets (about 19% wide)."""
+    def __init__(self, bounds=_BOUNDS_NS):
+        self.bounds = bounds
+        self.counts = array('Q', bytes(8 * (len(bounds) + 1)))
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, ns: int):
+        self.counts[bisect_right(self.bounds, ns)] += 1
+        self.count += 1
+        self.total += ns
+        if self.min is None or ns < self.min:
+            self.min = ns
+        if self.max is None or ns > self.max:
+            self.max = ns
+
+    def percentile(self, q: float) -> int:
+        """Returns the upper bound of the bucket holding the q-th percentile (0-100), in ns."""
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def __str__(self):
+        if not self.count:
+            return "no samples"
+        return (f"n {self.count}, mean {self.total / self.count / 1e6:.3f} ms, "
+                f"p50 {self.percentile(50) / 1e6:.3f} ms, p99 {self.percentile(99) / 1e6:.3f} ms, "
+                f"max {self.max / 1e6:.3f} ms")
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count, "total_ns": self.total, "min_ns": self.min, "max_ns": self.max,
+            "buckets": {str(self.bounds[i]) if i < len(self.bounds) else "inf": n
+                        for i, n in enumerate(self.counts) if n},
+        }
+
+
+def _label(name: str, key) -> str:
+    return name if key is None else f"{name}[{key}]"
+
+
+class Instruments():
+    """
+    Registry of named counters and histograms, each optionally split by a
+    key such as a node id. Counters and histograms may be updated from the
+    notifier thread and the main thread at once; an increment lost to that
+    race is accepted to keep the hot path lock-free.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def reset(self):
+        self.counters = {}   # (name, key) -> int
+        self.histograms = {} # (name, key) -> Histogram
+        self._marks = {}     # (name, key) -> monotonic_ns of the last mark()
+        self._started = time.monotonic_ns()
+
+    def count(self, name: str, key=None, n: int = 1):
+        self.counters[(name, key)] = self.counters.get((name, key), 0) + n
+
+    def histogram(self, name: str, key=None) -> Histogram:
+        histogram = self.histograms.get((name, key))
+        if histogram is None:
+            histogram = self.histograms[(name, key)] = Histogram()
+        return histogram
+
+    def record(self, name: str, key, ns: int):
+        self.histogram(name, key).record(ns)
+
+    def mark(self, name: str, key=None):
+        """Records the time since the previous mark of (name, key), e.g. between two heartbeats."""
+        now = time.monotonic_ns()
+        last = self._marks.get((name, key))
+        self._marks[(name, key)] = now
+        if last is not None:
+            self.record(name, key, now - last)
+
+    def summary(self) -> str:
+        lines = [f"instrumentation over {(time.monotonic_ns() - self._started) / 1e9:.1f} s:"]
+        for (name, key), value in sorted(self.counters.items(), key=lambda item: _label(*item[0])):
+            lines.append(f"  {_label(name, key)}: {value}")
+        for (name, key), histogram in sorted(self.histograms.items(), key=lambda item: _label(*item[0])):
+            lines.append(f"  {_label(name, key)}: {histogram}")
+        return "\n".join(lines)
+
+    def dump(self, path: str):
+        """Writes every counter and histogram to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump({
+                "seconds": (time.monotonic_ns() - self._started) / 1e9,
+                "counters": {_label(name, key): value for (name, key), value in self.counters.items()},
+                "histograms": {_label(name, key): histogram.to_dict() for (name, key), histogram in self.histograms.items()},
+            }, f, indent=4)
+
+
+instruments = Instruments()
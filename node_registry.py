@@ -0,0 +1,255 @@
+"""
+Maps node ids to the CAN buses they are wired to, so nodes are addressed by
+id alone however many interfaces the robot has.
+
+Buses are described in a JSON file such as config/buses.json:
+
+    {
+        "buses": {
+            "can0": {"node_ids": [11, 13, 21, 22, 23, 24]},
+            "can1": {"channel": "can1", "bitrate": 500000, "node_ids": []}
+        }
+    }
+
+`channel` defaults to the bus name, `interface` and `bitrate` to the ones
+given on the command line. Nodes that aren't listed are on the default bus.
+
+Each bus is opened on first use and gets its own dispatcher and notifier,
+so a busy bus never holds back the frames of another one. The registry
+offers the dispatcher's subscribe/unsubscribe and routes each subscription
+to the bus of its node, so it can be passed to AxisStateTracker and
+Telemetry in place of a dispatcher.
+"""
+import asyncio
+from dataclasses import dataclass
+from functools import lru_cache
+import json
+import time
+
+import can
+
+from can_simple_utils import CanDispatcher, CanSimpleNode
+
+buses_file = "config/buses.json"
+
+# Messages a drive sends on its own, by the endpoint setting their period
+# (0 turns them off). All of them are 8 byte frames.
+CYCLIC_RATES = (
+    'axis0.config.can.heartbeat_msg_rate_ms',
+    'axis0.config.can.encoder_msg_rate_ms',
+    'axis0.config.can.iq_msg_rate_ms',
+    'axis0.config.can.torques_msg_rate_ms',
+    'axis0.config.can.error_msg_rate_ms',
+    'axis0.config.can.temperature_msg_rate_ms',
+    'axis0.config.can.bus_voltage_msg_rate_ms',
+)
+
+
+@dataclass(frozen=True)
+class BusConfig():
+    name: str
+    interface: str
+    channel: str
+    bitrate: int
+    node_ids: tuple = ()
+
+
+def load_buses(path: str = buses_file, interface: str = 'socketcan', bitrate: int = 250000) -> dict:
+    """Returns the buses of a buses file by name."""
+    with open(path, 'r') as f:
+        data = json.load(f)
+    buses = {}
+    for name, bus in data['buses'].items():
+        buses[name] = BusConfig(name, bus.get('interface', interface), bus.get('channel', name),
+                                bus.get('bitrate', bitrate), tuple(bus.get('node_ids', ())))
+    assigned = {}
+    for bus in buses.values():
+        for node_id in bus.node_ids:
+            if node_id in assigned:
+                raise ValueError(f"node {node_id} is on both buses {assigned[node_id]} and {bus.name}")
+            assigned[node_id] = bus.name
+    return buses
+
+
+@lru_cache(maxsize=None)
+def frame_bits(dlc: int, extended: bool = False) -> int:
+    """Worst-case length of a data frame on the wire, stuff bits and interframe space included."""
+    stuffed = (54 if extended else 34) + 8 * dlc # bits exposed to bit stuffing
+    return stuffed + 13 + (stuffed - 1) // 4
+
+def cyclic_bits_per_second(config: dict) -> float:
+    """Returns the worst-case bus bandwidth taken by the cyclic messages of a drive with `config`."""
+    return sum(1000 / config[path] * frame_bits(8) for path in CYCLIC_RATES if config.get(path))
+
+
+class BusLoad(can.Listener):
+    """Counts the bits on the wire of the frames a notifier delivers, to tell how busy the bus is."""
+    def __init__(self, bitrate: int):
+        self.bitrate = bitrate
+        self.frames = 0
+        self.bits = 0
+        self.peak = 0.0
+        self._started = time.monotonic()
+        self._sampled = (self._started, 0) # time, bits at the last sample()
+
+    def on_message_received(self, msg: can.Message):
+        if msg.is_error_frame:
+            return
+        self.frames += 1
+        self.bits += frame_bits(msg.dlc, msg.is_extended_id)
+
+    def sample(self) -> float:
+        """Returns the load (0-1) since the previous sample, and keeps the highest one in `peak`."""
+        now = time.monotonic()
+        since, bits = self._sampled
+        self._sampled = (now, self.bits)
+        load = (self.bits - bits) / max(now - since, 1e-9) / self.bitrate
+        self.peak = max(self.peak, load)
+        return load
+
+    def average(self) -> float:
+        return self.bits / max(time.monotonic() - self._started, 1e-9) / self.bitrate
+
+
+class _OpenBus():
+    def __init__(self, config: BusConfig, listeners, accept_all: bool, receive_own_messages: bool, measure_load: bool):
+        bus_options = {}
+        if receive_own_messages or measure_load:
+            bus_options['receive_own_messages'] = True # so sent frames are recorded and counted too
+        self.config = config
+        self.bus = can.interface.Bus(config.channel, bustype=config.interface, bitrate=config.bitrate, **bus_options)
+
+        # Flush CAN RX buffer so there are no more old pending messages
+        while not (self.bus.recv(timeout=0) is None): pass
+
+        self.dispatcher = CanDispatcher(self.bus)
+        self.notifier = can.Notifier(self.bus, [self.dispatcher], loop=asyncio.get_running_loop())
+        self.load = None
+        if measure_load:
+            self.load = BusLoad(config.bitrate)
+            self.notifier.add_listener(self.load)
+        for listener in listeners:
+            self.notifier.add_listener(listener)
+        self.dispatcher.set_accept_all(accept_all or measure_load)
+
+    def close(self):
+        self.notifier.stop()
+        self.bus.shutdown()
+
+
+class NodeRegistry():
+    """
+    The buses of `buses` (BusConfig by name) and the nodes on them. Nodes
+    that no bus lists are on the `default` bus. `measure_load` lets every
+    frame through the acceptance filters to count them, see load_summary().
+    Buses must be opened from the event loop, so the registry is used from
+    coroutines; close() shuts every bus down.
+    """
+    def __init__(self, buses: dict, default: str = None, receive_own_messages: bool = False, measure_load: bool = False):
+        self.buses = buses
+        self.default = default
+        self.receive_own_messages = receive_own_messages
+        self.measure_load = measure_load
+        self._bus_names = {node_id: bus.name for bus in buses.values() for node_id in bus.node_ids}
+        self._open = {} # bus name -> _OpenBus
+        self._listeners = []
+        self._accept_all = False
+
+    @classmethod
+    def from_args(cls, interface: str, channel: str, bitrate: int, path: str = None, **options):
+        """
+        Buses of the buses file `path` if given, with `interface` and
+        `bitrate` as defaults, and `channel` as the bus of every other node.
+        """
+        buses = load_buses(path, interface, bitrate) if path else {}
+        default = next((bus.name for bus in buses.values() if bus.channel == channel and bus.interface == interface), None)
+        if default is None:
+            default = channel if channel not in buses else f"{interface}:{channel}"
+            buses[default] = BusConfig(default, interface, channel, bitrate)
+        return cls(buses, default, **options)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        for bus in self._open.values():
+            bus.close()
+        self._open = {}
+
+    def bus_name(self, node_id: int) -> str:
+        name = self._bus_names.get(node_id, self.default)
+        if name is None:
+            raise KeyError(f"node {node_id} isn't on any bus")
+        return name
+
+    def by_bus(self, node_ids) -> dict:
+        """Returns {bus name: [node ids]} for `node_ids`, in the order given."""
+        groups = {}
+        for node_id in node_ids:
+            groups.setdefault(self.bus_name(node_id), []).append(node_id)
+        return groups
+
+    def _get(self, name: str) -> _OpenBus:
+        bus = self._open.get(name)
+        if bus is None:
+            bus = self._open[name] = _OpenBus(self.buses[name], self._listeners, self._accept_all,
+                                              self.receive_own_messages, self.measure_load)
+        return bus
+
+    def open(self, node_ids):
+        """Opens the buses of `node_ids` right away instead of on first use."""
+        for name in self.by_bus(node_ids):
+            self._get(name)
+
+    def bus(self, node_id: int) -> can.BusABC:
+        return self._get(self.bus_name(node_id)).bus
+
+    def bitrate(self, node_id: int) -> int:
+        return self.buses[self.bus_name(node_id)].bitrate
+
+    def dispatcher(self, node_id: int) -> CanDispatcher:
+        return self._get(self.bus_name(node_id)).dispatcher
+
+    def node(self, node_id: int) -> CanSimpleNode:
+        """Returns a node sharing the dispatcher of its bus."""
+        bus = self._get(self.bus_name(node_id))
+        return CanSimpleNode(bus.bus, node_id, bus.dispatcher)
+
+    def subscribe(self, node_id: int, cmd_id: int, callback):
+        self.dispatcher(node_id).subscribe(node_id, cmd_id, callback)
+
+    def unsubscribe(self, node_id: int, cmd_id: int, callback):
+        bus = self._open.get(self.bus_name(node_id))
+        if bus is not None: # nothing is subscribed on a bus that was closed
+            bus.dispatcher.unsubscribe(node_id, cmd_id, callback)
+
+    def set_accept_all(self, accept_all: bool):
+        """CanDispatcher.set_accept_all() on every bus, opened or not yet."""
+        self._accept_all = accept_all
+        for bus in self._open.values():
+            bus.dispatcher.set_accept_all(accept_all or self.measure_load)
+
+    def add_listener(self, listener: can.Listener):
+        """Adds `listener` to the notifier of every bus, opened or not yet."""
+        self._listeners.append(listener)
+        for bus in self._open.values():
+            bus.notifier.add_listener(listener)
+
+    def load_summary(self, average: bool = False) -> list:
+        """
+        Returns one line per open bus with its load since the previous call
+        (or since it was opened, with `average`), if measure_load is set.
+        """
+        lines = []
+        for name, bus in self._open.items():
+            if bus.load is None:
+                continue
+            if average:
+                load = f"average load {bus.load.average() * 100:.1f}%"
+            else:
+                load = f"load {bus.load.sample() * 100:.1f}%, peak {bus.load.peak * 100:.1f}%"
+            lines.append(f"bus {name} ({bus.config.channel}, {bus.config.bitrate / 1000:g} kbit/s): {load}, {bus.load.frames} frames")
+        return lines
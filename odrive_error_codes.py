@@ -1,4 +1,7 @@
 # odrive_error_codes.py
+from enum import IntEnum, IntFlag
+import functools
+from typing import NamedTuple
 
 ERROR_CODES = {
     1: "INITIALIZING - The system is initializing or reconfiguring.",
@@ -25,13 +28,58 @@ ERROR_CODES = {
     1073741824: "CALIBRATION_ERROR - A calibration procedure failed."
 }
 
+ODriveError = IntFlag('ODriveError', {desc.split(' - ')[0]: code for code, desc in ERROR_CODES.items()})
+
+
+class Severity(IntEnum):
+    NONE = 0
+    INFO = 1      # not a fault, e.g. the drive is still starting up
+    WARNING = 2   # the axis was disarmed but clearing the errors is enough to go on
+    FAULT = 3     # needs attention (wiring, configuration, hardware) before it's cleared
+
+_SEVERITY = {
+    ODriveError.INITIALIZING: Severity.INFO,
+    ODriveError.MISSING_INPUT: Severity.WARNING,
+    ODriveError.DC_BUS_UNDER_VOLTAGE: Severity.WARNING,
+    ODriveError.VELOCITY_LIMIT_VIOLATION: Severity.WARNING,
+    ODriveError.POSITION_LIMIT_VIOLATION: Severity.WARNING,
+    ODriveError.WATCHDOG_TIMER_EXPIRED: Severity.WARNING,
+    ODriveError.ESTOP_REQUESTED: Severity.WARNING,
+}
+
+
+class DecodedError(NamedTuple):
+    flags: tuple        # ODriveError members of the set bits, lowest bit first
+    severity: Severity  # highest severity of the set bits
+    description: str    # one line per set bit, "No error." when none is set
+
+    def names(self) -> str:
+        return "|".join(flag.name or hex(flag) for flag in self.flags) or "NONE"
+
+
+@functools.lru_cache(maxsize=256)
+def decode_error(error_code: int) -> DecodedError:
+    """
+    Decodes an error bitmask (e.g. the heartbeat's axis error). Only the set
+    bits are visited, and the result is memoized, so decoding every
+    heartbeat is cheap. Has no side effects.
+    """
+    flags = []
+    descriptions = []
+    severity = Severity.NONE
+    bits = error_code
+    while bits:
+        bit = bits & -bits
+        bits ^= bit
+        flags.append(ODriveError(bit))
+        descriptions.append(ERROR_CODES.get(bit, f"UNKNOWN_ERROR - Undocumented error bit 0x{bit:x}."))
+        severity = max(severity, _SEVERITY.get(bit, Severity.FAULT))
+    return DecodedError(tuple(flags), severity, "\n".join(descriptions) if descriptions else "No error.")
+
+
 def get_error_description(error_code):
     """
     Returns a human-readable description for a given error code.
     This handles both individual errors and combined error bitmasks.
     """
-    description = []
-    for code, desc in ERROR_CODES.items():
-        if error_code & code:
-            description.append(desc)
-    return "\n".join(description) if description else "No error."
+    return decode_error(error_code).description
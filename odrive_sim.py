@@ -0,0 +1,220 @@
+"""
+In-process simulation of ODrives speaking the subset of CANSimple this
+project uses, so configure and teleop code can run without hardware.
+
+Each simulated node answers Get_Version, RxSdo reads/writes (against the
+flat_endpoints table of its firmware), Set_Axis_State, Set_Input_Vel,
+Reboot and Clear_Errors, and sends heartbeats (and optionally encoder
+estimates) periodically. Replies can be delayed and requests dropped to
+mimic a busy bus.
+
+Usage:
+    with ODriveSimulator("sim", [21, 22, 23, 24]) as sim:
+        bus = can.interface.Bus("sim", interface="virtual")
+        ...
+"""
+from dataclasses import dataclass, field
+import heapq
+import random
+import struct
+import threading
+import time
+
+import can
+
+from axis_state import CLOSED_LOOP_CONTROL, FULL_CALIBRATION_SEQUENCE, HEARTBEAT, IDLE, PROCEDURE_BUSY, PROCEDURE_SUCCESS
+from can_simple_utils import CLEAR_ERRORS_CMD, GET_VERSION_CMD, HEARTBEAT_CMD, REBOOT_CMD, \
+    REBOOT_ACTION_ERASE, REBOOT_ACTION_SAVE, SET_AXIS_STATE_CMD, SET_INPUT_VEL_CMD, TX_SDO_CMD
+from endpoint_table import load_endpoint_table
+from sdo_transactions import OPCODE_WRITE, RX_SDO_CMD, SDO_HEADER
+
+GET_ENCODER_ESTIMATES_CMD = 0x09
+
+_FLOATS = struct.Struct('<ff')
+
+
+@dataclass
+class SimulatedAxis():
+    node_id: int
+    values: dict = field(default_factory=dict) # endpoint id -> value, what the drive runs with
+    saved: dict = field(default_factory=dict)  # endpoint id -> value, what is in NVM
+    state: int = IDLE
+    error: int = 0
+    procedure_result: int = PROCEDURE_SUCCESS
+    input_vel: float = 0.0
+    pos: float = 0.0
+    calibration_done: float = None # time.monotonic() at which the running calibration ends
+    rebooting_until: float = 0.0   # time.monotonic() at which a reboot ends, silent until then
+
+
+class ODriveSimulator():
+    """
+    Simulates `node_ids` on the python-can virtual bus `channel`.
+
+    `latency` delays every reply by that many seconds, `drop_rate` is the
+    probability that a request is silently lost, and the commands of
+    `drop_cmds` are always lost. `calibration_time` is how long a full
+    calibration sequence keeps the axis busy, `reboot_time` how long a
+    rebooting drive sends and answers nothing.
+    """
+    def __init__(self, channel: str, node_ids, fw_version: str = "0.6.10", latency: float = 0.0,
+                 drop_rate: float = 0.0, heartbeat_interval: float = 0.1, encoder_interval: float = None,
+                 calibration_time: float = 0.5, reboot_time: float = 0.3, drop_cmds=(), seed: int = None):
+        self.endpoints = load_endpoint_table(fw_version)
+        self.endpoints_by_id = {endpoint.id: endpoint for endpoint in self.endpoints}
+        self.fw_version = tuple(int(x) for x in fw_version.split('.'))
+        self.hw_version = tuple(int(x) for x in self.endpoints.hw_version.split('.'))
+        self.axes = {node_id: SimulatedAxis(node_id) for node_id in node_ids}
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.heartbeat_interval = heartbeat_interval
+        self.encoder_interval = encoder_interval
+        self.calibration_time = calibration_time
+        self.reboot_time = reboot_time
+        self.drop_cmds = frozenset(drop_cmds)
+        self.received = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._bus = can.interface.Bus(channel, interface='virtual')
+        self._outbox = [] # heap of (due time, sequence, message)
+        self._outbox_seq = 0
+        self._outbox_ready = threading.Condition()
+        self._stopped = False
+        self._threads = [threading.Thread(target=target, daemon=True)
+                         for target in (self._receive, self._transmit, self._periodic)]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped = True
+        with self._outbox_ready:
+            self._outbox_ready.notify()
+        for thread in self._threads:
+            thread.join()
+        self._bus.shutdown()
+
+    def _send(self, node_id: int, cmd_id: int, data: bytes, delay: float = 0.0):
+        msg = can.Message(arbitration_id=node_id << 5 | cmd_id, data=data, is_extended_id=False)
+        if delay <= 0:
+            self._bus.send(msg)
+            return
+        with self._outbox_ready:
+            self._outbox_seq += 1
+            heapq.heappush(self._outbox, (time.monotonic() + delay, self._outbox_seq, msg))
+            self._outbox_ready.notify()
+
+    def _transmit(self):
+        with self._outbox_ready:
+            while not self._stopped:
+                if not self._outbox:
+                    self._outbox_ready.wait()
+                    continue
+                due, _, msg = self._outbox[0]
+                now = time.monotonic()
+                if due > now:
+                    self._outbox_ready.wait(due - now)
+                    continue
+                heapq.heappop(self._outbox)
+                self._bus.send(msg)
+
+    def _periodic(self):
+        next_heartbeat = next_encoder = time.monotonic()
+        while not self._stopped:
+            now = time.monotonic()
+            for axis in self.axes.values():
+                if axis.calibration_done is not None and now >= axis.calibration_done:
+                    axis.calibration_done = None
+                    axis.state = IDLE
+                    axis.procedure_result = PROCEDURE_SUCCESS
+
+            if now >= next_heartbeat:
+                next_heartbeat += self.heartbeat_interval
+                for axis in self.axes.values():
+                    if now < axis.rebooting_until:
+                        continue
+                    self._send(axis.node_id, HEARTBEAT_CMD,
+                               HEARTBEAT.pack(axis.error, axis.state, axis.procedure_result, 1) + b'\x00')
+
+            if self.encoder_interval and now >= next_encoder:
+                next_encoder += self.encoder_interval
+                for axis in self.axes.values():
+                    if now < axis.rebooting_until:
+                        continue
+                    vel = axis.input_vel if axis.state == CLOSED_LOOP_CONTROL else 0.0
+                    axis.pos += vel * self.encoder_interval
+                    self._send(axis.node_id, GET_ENCODER_ESTIMATES_CMD, _FLOATS.pack(axis.pos, vel))
+
+            wake = min(next_heartbeat, next_encoder if self.encoder_interval else next_heartbeat)
+            time.sleep(max(0.0, min(wake - time.monotonic(), 0.01)))
+
+    def _receive(self):
+        while not self._stopped:
+            msg = self._bus.recv(0.05)
+            if msg is None or msg.is_extended_id:
+                continue
+            axis = self.axes.get(msg.arbitration_id >> 5)
+            if axis is None:
+                continue
+            self.received += 1
+            if (time.monotonic() < axis.rebooting_until or msg.arbitration_id & 0x1F in self.drop_cmds
+                    or self.drop_rate and self._random.random() < self.drop_rate):
+                self.dropped += 1
+                continue
+            self._handle(axis, msg.arbitration_id & 0x1F, bytes(msg.data))
+
+    def _handle(self, axis: SimulatedAxis, cmd_id: int, data: bytes):
+        if cmd_id == GET_VERSION_CMD:
+            self._send(axis.node_id, GET_VERSION_CMD,
+                       bytes((2, *self.hw_version, *self.fw_version, 0)), self.latency)
+
+        elif cmd_id == RX_SDO_CMD:
+            opcode, endpoint_id, _ = SDO_HEADER.unpack_from(data)
+            endpoint = self.endpoints_by_id.get(endpoint_id)
+            if endpoint is None:
+                return
+            if opcode == OPCODE_WRITE:
+                axis.values[endpoint_id] = endpoint.sdo.unpack_from(data)[3]
+            else:
+                value = axis.values.get(endpoint_id, _DEFAULTS[endpoint.type])
+                self._send(axis.node_id, TX_SDO_CMD, endpoint.sdo.pack(0, endpoint_id, 0, value), self.latency)
+
+        elif cmd_id == SET_AXIS_STATE_CMD:
+            state, = struct.unpack_from('<I', data)
+            if state == FULL_CALIBRATION_SEQUENCE:
+                axis.procedure_result = PROCEDURE_BUSY
+                axis.calibration_done = time.monotonic() + self.calibration_time
+            axis.state = state
+
+        elif cmd_id == SET_INPUT_VEL_CMD:
+            axis.input_vel, _ = _FLOATS.unpack_from(data)
+
+        elif cmd_id == CLEAR_ERRORS_CMD:
+            axis.error = 0
+
+        elif cmd_id == REBOOT_CMD:
+            action = data[0] if data else 0
+            if action == REBOOT_ACTION_SAVE:
+                axis.saved = dict(axis.values)
+            elif action == REBOOT_ACTION_ERASE:
+                axis.saved = {}
+            axis.values = dict(axis.saved)
+            axis.state = IDLE
+            axis.input_vel = 0.0
+            axis.calibration_done = None
+            axis.rebooting_until = time.monotonic() + self.reboot_time
+
+
+_DEFAULTS = {
+    'bool': False, 'float': 0.0,
+    'uint8': 0, 'int8': 0, 'uint16': 0, 'int16': 0,
+    'uint32': 0, 'int32': 0, 'uint64': 0, 'int64': 0,
+}
@@ -1,46 +1,41 @@
 """
-Minimal example for controlling an ODrive via the CANSimple protocol.
+Drives the tracks with an Xbox controller over CAN bus.
 
-Puts the ODrive into closed loop control mode, sends a velocity setpoint of 1.0
-and then prints the encoder feedback.
+Everything runs on one asyncio event loop fed by one notifier per bus: the
+control loop, state transitions, heartbeat tracking, telemetry and the
+periodic stats are concurrent tasks or receive callbacks on that loop, so
+waiting for the drives to change state never holds back the setpoints. The
+controller is read by its own thread, which only wakes the control loop up.
+Nodes are addressed by id, the registry knows which bus each is on (see
+node_registry.py and --buses).
 
-Assumes that the ODrive is already configured for velocity control.
+Assumes that the ODrives are already configured for velocity control.
+
+To try it without hardware, against simulated drives on a virtual bus:
+    python run.py -i virtual -c sim --simulate
 
 See https://docs.odriverobotics.com/v/latest/manual/can-protocol.html for protocol
 documentation.
 """
 
-import can
-import struct
-
-from can_simple_utils import CanSimpleNode
-
-import tty
-import sys
-import termios
+import argparse
+import asyncio
+from time import monotonic
 
+from axis_state import AxisStateTracker, CLOSED_LOOP_CONTROL, IDLE
+from can_simple_utils import NodeGroup, SetpointPublisher
+from control_loop import RateLoop
+from instrumentation import instruments
+from node_registry import NodeRegistry, buses_file
+from odrive_error_codes import decode_error
 from xbox_controller import XboxController
-from time import sleep
-
-CLOSED_LOOP_CONTROL=8
-IDLE=1
 
 min_speed = 0
 max_speed = 58
 
-bus = can.interface.Bus("can0", bustype="socketcan", bytrate=250000)
-
-# Flush CAN RX buffer so there are no more old pending messages
-while not (bus.recv(timeout=0) is None): pass
-
 right_tracks_node_ids = [21, 22]
 left_tracks_node_ids = [23, 24]
 
-# Initialize CAN nodes dynamically
-right_tracks = [CanSimpleNode(bus, node_id) for node_id in right_tracks_node_ids]
-left_tracks = [CanSimpleNode(bus, node_id) for node_id in left_tracks_node_ids]
-
-use_tank_drive = False
 debug_print = False
 
 def tank_drive(x_axis, y_axis):
@@ -50,106 +45,255 @@ def tank_drive(x_axis, y_axis):
     right_speed = max(-1, min(1, right_speed))
     return left_speed, right_speed
 
-def set_state(state):
-    for node in right_tracks + left_tracks:
-        node.set_state_msg(state)
-    waitState(state)
-    print("Mode:", "Controlled" if state == CLOSED_LOOP_CONTROL else "Idle")
-
-def runRight(speed):
-    for node in right_tracks:
-        node.set_velocity(speed)
-
-def runLeft(speed):
-    for node in left_tracks:
-        node.set_velocity(-speed)
-
-def clearErr():
-    for node in right_tracks + left_tracks:
-        node.clear_errors_msg()
-
-def waitState(stateWaited):
-    for msg in bus:
-        for node in right_tracks + left_tracks:
-            node.wait_state(stateWaited, msg)
-        if debug_print:
-            print([node.connected for node in right_tracks + left_tracks])
-        if all(node.connected for node in right_tracks + left_tracks):
-            break
-
-clearErr()
-set_state(IDLE)
-
-for node in right_tracks + left_tracks:
-    node.set_velocity(0)
-
-xbox_controller = XboxController()
-isOpen = False
-isClearError = False
-
-try:
-    while True:
-        sleep(0.1)
-        speed = max(xbox_controller.RightTrigger * max_speed - 0.1, 0)
-
-        if (xbox_controller.A == 1 or xbox_controller.RightBumper == 1) and not isOpen:
-            use_tank_drive = xbox_controller.A == 1
-            set_state(CLOSED_LOOP_CONTROL)
-            isOpen = True
-
-        if ((xbox_controller.A == 0 and xbox_controller.RightBumper == 0) or not xbox_controller.Connected) and isOpen:
-            set_state(IDLE)
-            isOpen = False
-
-        if xbox_controller.B == 1 and not isClearError:
-            clearErr()
-            isClearError = True
-
-        if xbox_controller.B == 0 and isClearError:
-            isClearError = False
-
-        if xbox_controller.UpDPad == 1:
-            runRight(speed)
-            runLeft(speed)
-            if debug_print: print("Moving forward", speed)
-
-        elif xbox_controller.DownDPad == 1:
-            runRight(-speed)
-            runLeft(-speed)
-            if debug_print: print("Moving backward", speed)
-
-        elif xbox_controller.LeftDPad == 1:
-            runRight(speed)
-            runLeft(-speed)
-            if debug_print: print("Turning left", speed)
-
-        elif xbox_controller.RightDPad == 1:
-            runRight(-speed)
-            runLeft(speed)
-            if debug_print: print("Turning right", speed)
-
-        else:
-            if use_tank_drive:
-                right, left = tank_drive(xbox_controller.LeftJoystickX, xbox_controller.LeftJoystickY)
-                runRight(right * max_speed)
-                runLeft(left * max_speed)
-                if debug_print:
-                    print(f'{xbox_controller.LeftJoystickX:.2f} {xbox_controller.LeftJoystickY:.2f} {left:.2f} {right:.2f}')
+
+class Teleop():
+    """Drive state of the tracks, commanded from the control loop task."""
+    def __init__(self, registry: NodeRegistry, rate: float, telemetry=None):
+        self.registry = registry
+        self.right_tracks = [registry.node(node_id) for node_id in right_tracks_node_ids]
+        self.left_tracks = [registry.node(node_id) for node_id in left_tracks_node_ids]
+        self.node_ids = right_tracks_node_ids + left_tracks_node_ids
+
+        # Each side is commanded as one burst, the left motors are mounted mirrored
+        self.right_group = NodeGroup(self.right_tracks)
+        self.left_group = NodeGroup(self.left_tracks, signs=[-1] * len(self.left_tracks))
+
+        # Setpoints only go out when they change, plus a keep-alive for the watchdog
+        self.right_setpoint = SetpointPublisher(self.right_group)
+        self.left_setpoint = SetpointPublisher(self.left_group)
+
+        # Axis states, errors and liveness of every node, kept up to date from
+        # the heartbeats
+        self.axis_states = AxisStateTracker(registry, self.node_ids, on_error=self.on_axis_error)
+        self.telemetry = telemetry
+        self.loop = RateLoop(rate)
+        self._transition = None # task waiting for the requested state
+
+    @staticmethod
+    def on_axis_error(status):
+        if not status.error:
+            print(f"CAN {status.node_id} errors cleared")
+            return
+        decoded = decode_error(status.error)
+        print(f"CAN {status.node_id} Error Code: {status.error} ({decoded.severity.name}) - {decoded.description}")
+
+    def request_state(self, state, timeout=2.0):
+        """Sends the state change and returns right away, the outcome is reported by a task."""
+        if self._transition is not None:
+            self._transition.cancel()
+        requested_at = monotonic()
+        self.right_group.set_state_msg(state)
+        self.left_group.set_state_msg(state)
+        self.right_setpoint.reset()
+        self.left_setpoint.reset()
+        self._transition = asyncio.create_task(self._await_state(state, requested_at, timeout))
+
+    async def _await_state(self, state, since, timeout):
+        lagging = await self.axis_states.wait_for_state_async(self.node_ids, state, timeout, since)
+        if lagging:
+            print("Timed out waiting for nodes", lagging)
+            return
+        print("Mode:", "Controlled" if state == CLOSED_LOOP_CONTROL else "Idle")
+        if state == IDLE:
+            # Errors were reported by on_axis_error when they came up; once
+            # idle they are cleared so the next arm attempt isn't refused
+            for node in self.right_tracks + self.left_tracks:
+                if self.axis_states.status(node.node_id).error:
+                    node.clear_errors_msg()
+
+    async def set_state(self, state, timeout=2.0):
+        self.request_state(state, timeout)
+        await self._transition
+
+    def runRight(self, speed):
+        self.right_setpoint.set_velocity(speed)
+
+    def runLeft(self, speed):
+        self.left_setpoint.set_velocity(speed)
+
+    def stop(self):
+        self.right_group.set_velocity(0)
+        self.left_group.set_velocity(0)
+
+    def clearErr(self):
+        for node in self.right_tracks + self.left_tracks:
+            node.clear_errors_msg()
+
+    def setpoint_stats(self):
+        sent = (self.right_setpoint.sent * len(self.right_tracks)) + (self.left_setpoint.sent * len(self.left_tracks))
+        suppressed = (self.right_setpoint.suppressed * len(self.right_tracks)) + (self.left_setpoint.suppressed * len(self.left_tracks))
+        return f"setpoint frames: {sent} sent, {suppressed} suppressed"
+
+    def print_stats(self):
+        print(self.loop.stats())
+        print(self.setpoint_stats())
+        silent = self.axis_states.silent(1.0)
+        if silent:
+            print("No heartbeat from nodes", silent)
+        if self.telemetry is not None:
+            for node_id in self.node_ids:
+                print(self.telemetry.summary(node_id))
+        for line in self.registry.load_summary():
+            print(line)
+        if instruments.enabled:
+            print(instruments.summary())
+
+    async def report(self, interval=5.0):
+        """Prints the loop, setpoint and drive stats every `interval` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            self.print_stats()
+            self.loop.reset_stats()
+
+    async def control(self, xbox_controller: XboxController, updated: asyncio.Event):
+        """Control loop, woken up early by `updated` when the controller publishes a new report."""
+        use_tank_drive = False
+        isOpen = False
+        isClearError = False
+
+        while True:
+            await self.loop.wait_async(updated)
+            controller = xbox_controller.snapshot()
+
+            speed = max(controller.RightTrigger * max_speed - 0.1, 0)
+
+            # A disconnected controller never re-arms, whatever its last buttons were
+            if (controller.A == 1 or controller.RightBumper == 1) and controller.Connected and not isOpen:
+                use_tank_drive = controller.A == 1
+                self.request_state(CLOSED_LOOP_CONTROL)
+                isOpen = True
+
+            if ((controller.A == 0 and controller.RightBumper == 0) or not controller.Connected) and isOpen:
+                self.request_state(IDLE)
+                isOpen = False
+
+            if controller.B == 1 and not isClearError:
+                self.clearErr()
+                isClearError = True
+
+            if controller.B == 0 and isClearError:
+                isClearError = False
+
+            if controller.UpDPad == 1:
+                self.runRight(speed)
+                self.runLeft(speed)
+                if debug_print: print("Moving forward", speed)
+
+            elif controller.DownDPad == 1:
+                self.runRight(-speed)
+                self.runLeft(-speed)
+                if debug_print: print("Moving backward", speed)
+
+            elif controller.LeftDPad == 1:
+                self.runRight(speed)
+                self.runLeft(-speed)
+                if debug_print: print("Turning left", speed)
+
+            elif controller.RightDPad == 1:
+                self.runRight(-speed)
+                self.runLeft(speed)
+                if debug_print: print("Turning right", speed)
+
             else:
-                runRight(xbox_controller.RightJoystickY * max_speed)
-                runLeft(xbox_controller.LeftJoystickY * max_speed)
-                if debug_print:
-                    print(f'{xbox_controller.LeftJoystickY:.2f} {xbox_controller.RightJoystickY:.2f}')
-
-except KeyboardInterrupt:
-    print()
-
-set_state(IDLE)
-bus.shutdown()
-print("Application exited")
-
-# Print encoder feedback
-# for msg in bus:
-#     if msg.arbitration_id == (node_id << 5 | 0x09): # 0x09: Get_Encoder_Estimates
-#         pos, vel = struct.unpack('<ff', bytes(msg.data))
-#         print(f"pos: {pos:.3f} [turns], vel: {vel:.3f} [turns/s]")
+                if use_tank_drive:
+                    right, left = tank_drive(controller.LeftJoystickX, controller.LeftJoystickY)
+                    self.runRight(right * max_speed)
+                    self.runLeft(left * max_speed)
+                    if debug_print:
+                        print(f'{controller.LeftJoystickX:.2f} {controller.LeftJoystickY:.2f} {left:.2f} {right:.2f}')
+                else:
+                    self.runRight(controller.RightJoystickY * max_speed)
+                    self.runLeft(controller.LeftJoystickY * max_speed)
+                    if debug_print:
+                        print(f'{controller.LeftJoystickY:.2f} {controller.RightJoystickY:.2f}')
+
+
+async def main(args):
+    loop = asyncio.get_running_loop()
+
+    node_ids = right_tracks_node_ids + left_tracks_node_ids
+    # Each bus gets a dispatcher routing received frames to whoever
+    # subscribed to them, its callbacks run on the event loop. The recording
+    # has the setpoints too.
+    registry = NodeRegistry.from_args(args.interface, args.channel, args.bitrate, args.buses,
+                                      receive_own_messages=bool(args.record), measure_load=args.bus_load)
+
+    simulators = []
+    if args.simulate:
+        from odrive_sim import ODriveSimulator
+        for name, bus_node_ids in registry.by_bus(node_ids).items():
+            if registry.buses[name].interface != 'virtual':
+                raise SystemExit(f"--simulate needs every bus on the virtual interface, {name} is on {registry.buses[name].interface}")
+            simulators.append(ODriveSimulator(registry.buses[name].channel, bus_node_ids, encoder_interval=0.01))
+            simulators[-1].start()
+
+    registry.open(node_ids)
+
+    recorder = None
+    if args.record:
+        from can_log import CanRecorder
+        recorder = CanRecorder(args.record)
+        registry.set_accept_all(True)
+        registry.add_listener(recorder)
+
+    telemetry = None
+    if args.telemetry:
+        from telemetry import Telemetry
+        telemetry = Telemetry(registry, node_ids)
+
+    teleop = Teleop(registry, args.rate, telemetry)
+
+    xbox_controller = XboxController()
+    updated = asyncio.Event()
+    xbox_controller.add_listener(lambda state: loop.call_soon_threadsafe(updated.set))
+
+    try:
+        teleop.clearErr()
+        await teleop.set_state(IDLE)
+        teleop.stop()
+
+        tasks = [teleop.control(xbox_controller, updated)]
+        if args.stats:
+            tasks.append(teleop.report())
+        await asyncio.gather(*tasks)
+
+    except asyncio.CancelledError: # Ctrl+C
+        print()
+        teleop.print_stats()
+
+    finally:
+        await teleop.set_state(IDLE)
+        registry.close()
+        if recorder is not None:
+            print(f"recorded {recorder.recorded} frames to {args.record} ({recorder.dropped} dropped)")
+        if instruments.enabled:
+            instruments.dump(args.instrument)
+        for simulator in simulators:
+            simulator.stop()
+        print("Application exited")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Drive the tracks with an Xbox controller over CAN bus.')
+    parser.add_argument('-i', '--interface', type=str, default='socketcan', help='Interface type (e.g., socketcan, virtual). Default is socketcan.')
+    parser.add_argument('-c', '--channel', type=str, default='can0', help='Channel/path/interface name of the device. Default is can0.')
+    parser.add_argument('-b', '--bitrate', type=int, default=250000, help='Bitrate for CAN bus. Default is 250000.')
+    parser.add_argument('--buses', type=str, metavar='FILE', help=f'Nodes on other buses than -c, e.g. {buses_file}. -i and -b are the defaults of its buses.')
+    parser.add_argument('--bus-load', action='store_true', help='Measure the load of every bus, printed along with --stats. Lets every frame through the acceptance filters.')
+    parser.add_argument('--simulate', action='store_true', help='Simulate the drives in-process (use with -i virtual).')
+    parser.add_argument('-r', '--rate', type=float, default=50, help='Control loop rate in Hz. Default is 50.')
+    parser.add_argument('--stats', action='store_true', help='Print control loop statistics every 5 seconds.')
+    parser.add_argument('--record', type=str, help='Record all CAN traffic to this file (see can_log.py).')
+    parser.add_argument('--telemetry', action='store_true', help='Record the drives\' cyclic messages (needs numpy), printed along with --stats.')
+    parser.add_argument('--instrument', type=str, metavar='FILE', help='Measure send counts, timeouts, heartbeat intervals and loop timing, printed along with --stats and written to FILE on exit.')
+    args = parser.parse_args()
+    if args.simulate and args.interface != 'virtual':
+        parser.error("--simulate needs -i virtual")
+
+    if args.instrument:
+        instruments.enable()
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,184 @@
+"""
+Reliable RxSdo/TxSdo exchanges with a node over a lossy or busy bus.
+
+Every request is tracked by (node id, endpoint id, opcode) until its TxSdo
+reply arrives. A request that gets no reply within the retransmission
+timeout is sent again, up to `retries` times; reads and writes of plain
+endpoint values are idempotent, so repeating them is safe. A write whose
+read-back doesn't verify is repeated the same way, since the write frame
+may have been the one that got lost.
+
+The timeout follows the measured round trip time the way TCP's does
+(RFC 6298: smoothed RTT plus four times its deviation, doubled on every
+timeout, no samples from retransmitted requests). The number of requests in
+flight is adjusted like a TCP congestion window: it grows by one per
+window of replies and halves on a timeout, since lost replies on CAN
+usually mean a saturated bus or a drive that can't keep up.
+"""
+import asyncio
+from dataclasses import dataclass
+import struct
+import time
+
+import can
+
+from can_simple_utils import CanSimpleNode, TX_SDO_CMD
+from endpoint_table import Endpoint
+from instrumentation import instruments
+
+OPCODE_READ = 0x00
+OPCODE_WRITE = 0x01
+
+RX_SDO_CMD = 0x04
+
+SDO_HEADER = struct.Struct('<BHB') # opcode, endpoint id, reserved
+
+
+class RttEstimator():
+    """Retransmission timeout from the observed round trip times (RFC 6298)."""
+    def __init__(self, initial_timeout: float = 1.0, min_timeout: float = 0.05, max_timeout: float = 2.0):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = initial_timeout
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(max(self.srtt + 4 * self.rttvar, self.min_timeout), self.max_timeout)
+
+    def backoff(self):
+        self.timeout = min(self.timeout * 2, self.max_timeout)
+
+
+@dataclass
+class _Request():
+    endpoint: Endpoint
+    value: object
+    opcode: int
+    sent_at: float = 0.0 # time.monotonic() of the last attempt
+    attempts: int = 0
+
+
+class SdoTransactions():
+    """
+    SDO request/reply tracking for one node. `window` is the most requests
+    kept in flight; the actual number shrinks when replies time out and
+    grows back as they come in again.
+    """
+    def __init__(self, node: CanSimpleNode, window: int = 8, retries: int = 3, rtt: RttEstimator = None):
+        self.node = node
+        self.max_window = window
+        self.window = float(window)
+        self.retries = retries
+        self.rtt = rtt or RttEstimator()
+        self.retransmissions = 0
+
+    def send_write(self, endpoint: Endpoint, val):
+        self.node.send(can.Message(
+            arbitration_id=(self.node.node_id << 5 | RX_SDO_CMD),
+            data=endpoint.sdo.pack(OPCODE_WRITE, endpoint.id, 0, val),
+            is_extended_id=False
+        ))
+
+    def send_read(self, endpoint: Endpoint):
+        self.node.send(can.Message(
+            arbitration_id=(self.node.node_id << 5 | RX_SDO_CMD),
+            data=SDO_HEADER.pack(OPCODE_READ, endpoint.id, 0),
+            is_extended_id=False
+        ))
+
+    def _send(self, request: _Request):
+        # A write gets no reply of its own, it's confirmed by reading it back
+        if request.opcode == OPCODE_WRITE:
+            self.send_write(request.endpoint, request.value)
+        self.send_read(request.endpoint)
+        request.sent_at = time.monotonic()
+        request.attempts += 1
+
+    def _on_timeout(self, request: _Request):
+        self.rtt.backoff()
+        self.window = max(1.0, self.window / 2)
+        if request.attempts > self.retries:
+            raise TimeoutError(f"no reply for {request.endpoint.path} after {request.attempts} attempts")
+        self._retry(request)
+
+    def _retry(self, request: _Request):
+        self.retransmissions += 1
+        if instruments.enabled:
+            instruments.count("sdo_retries", self.node.node_id)
+        self._send(request)
+
+    def _on_reply(self, request: _Request):
+        if request.attempts == 1: # a reply to a retransmitted request can't tell which attempt it answers
+            rtt = time.monotonic() - request.sent_at
+            self.rtt.sample(rtt)
+            if instruments.enabled:
+                instruments.record("sdo_rtt", self.node.node_id, int(rtt * 1e9))
+        self.window = min(float(self.max_window), self.window + 1 / self.window)
+
+    async def exchange(self, plan, write: bool, window: int = None, verify=None) -> list:
+        """
+        Sends a read (preceded by a write if `write` is set) for every
+        (Endpoint, value) pair of `plan` and returns a list of (Endpoint,
+        value, returned value) once all of them were answered. TxSdo replies
+        are matched to their request by the endpoint id echoed in the reply
+        header, so the drive may answer in any order. `window` replaces the
+        maximum number of requests in flight. `verify(endpoint, value,
+        returned value)` tells whether a write took effect; if not, it is
+        repeated within the same retry budget. Raises TimeoutError when a
+        request is still unanswered after all retries.
+        """
+        if window is not None:
+            self.max_window = window
+            self.window = min(self.window, float(window))
+        node_id = self.node.node_id
+        opcode = OPCODE_WRITE if write else OPCODE_READ
+        entries = iter(plan)
+        outstanding = {} # (node id, endpoint id, opcode) -> _Request, oldest attempt first
+        results = []
+
+        self.node.flush_rx()
+        while True:
+            while len(outstanding) < int(self.window):
+                entry = next(entries, None)
+                if entry is None:
+                    break
+                request = _Request(entry[0], entry[1], opcode)
+                self._send(request)
+                outstanding[(node_id, request.endpoint.id, opcode)] = request
+
+            if not outstanding:
+                return results
+
+            oldest_key, oldest = next(iter(outstanding.items()))
+            remaining = oldest.sent_at + self.rtt.timeout - time.monotonic()
+            msg = None
+            if remaining > 0:
+                try:
+                    msg = await self.node.await_msg(TX_SDO_CMD, remaining)
+                except asyncio.TimeoutError:
+                    pass
+            if msg is None:
+                # Move it to the back, it is now the most recent attempt
+                del outstanding[oldest_key]
+                self._on_timeout(oldest)
+                outstanding[oldest_key] = oldest
+                continue
+
+            _, endpoint_id, _ = SDO_HEADER.unpack_from(msg.data)
+            request = outstanding.pop((node_id, endpoint_id, opcode), None)
+            if request is None:
+                continue # stale reply from an earlier request or attempt
+            self._on_reply(request)
+            _, _, _, return_value = request.endpoint.sdo.unpack_from(msg.data)
+            if verify is not None and request.attempts <= self.retries and not verify(request.endpoint, request.value, return_value):
+                self._retry(request)
+                outstanding[(node_id, endpoint_id, opcode)] = request
+                continue
+            results.append((request.endpoint, request.value, return_value))
@@ -0,0 +1,140 @@
+"""
+Decoder and in-memory store for the cyclic messages the ODrives send on their
+own (rates set in config/can.json): heartbeat, errors, encoder estimates, Iq,
+temperatures, bus voltage/current and torques.
+
+Every (node, message) pair gets a fixed-size NumPy ring buffer, so memory
+stays bounded no matter how long the process runs.
+
+See https://docs.odriverobotics.com/v/latest/manual/can-protocol.html for the
+message layouts.
+"""
+import struct
+
+import numpy as np
+
+from can_simple_utils import CanDispatcher, HEARTBEAT_CMD
+from odrive_error_codes import decode_error
+
+# cmd id -> (message name, payload struct, field names)
+MESSAGES = {
+    HEARTBEAT_CMD: ("heartbeat", struct.Struct('<IBBB'), ("axis_error", "axis_state", "procedure_result", "trajectory_done")),
+    0x03: ("error", struct.Struct('<II'), ("active_errors", "disarm_reason")),
+    0x09: ("encoder", struct.Struct('<ff'), ("pos_estimate", "vel_estimate")),
+    0x14: ("iq", struct.Struct('<ff'), ("iq_setpoint", "iq_measured")),
+    0x15: ("temperature", struct.Struct('<ff'), ("fet_temperature", "motor_temperature")),
+    0x17: ("bus", struct.Struct('<ff'), ("bus_voltage", "bus_current")),
+    0x1c: ("torques", struct.Struct('<ff'), ("torque_target", "torque_estimate")),
+}
+
+# field name -> (cmd id, column in the message's ring buffer)
+_FIELDS = {field: (cmd_id, column + 1) for cmd_id, (_, _, fields) in MESSAGES.items() for column, field in enumerate(fields)}
+
+
+class RingBuffer():
+    """
+    Fixed-size buffer of rows of floats, the first column being the
+    timestamp.
+
+    Every row is written twice, at i and i + capacity, so the last n rows
+    are always one contiguous slice of the backing array. last() and
+    since() therefore return views without copying. The views keep
+    following the buffer as it is written to; copy them if you need the
+    values to stay put.
+    """
+    def __init__(self, capacity: int, columns: tuple):
+        self.capacity = capacity
+        self.columns = ("timestamp",) + tuple(columns)
+        self.count = 0
+        self._data = np.zeros((2 * capacity, len(self.columns)))
+        self._next = 0
+
+    def append(self, row):
+        i = self._next
+        self._data[i] = row
+        self._data[i + self.capacity] = row
+        self._next = i + 1 if i + 1 < self.capacity else 0
+        if self.count < self.capacity:
+            self.count += 1
+
+    def latest(self):
+        """Returns the last row, or None when nothing was appended yet."""
+        if not self.count:
+            return None
+        return self._data[self._next + self.capacity - 1]
+
+    def last(self, n: int):
+        """Returns a view of the last n rows (fewer if fewer were appended), oldest first."""
+        end = self._next + self.capacity
+        return self._data[end - min(n, self.count):end]
+
+    def since(self, timestamp: float):
+        """Returns a view of the rows whose timestamp is at least `timestamp`, oldest first."""
+        rows = self.last(self.count)
+        return rows[np.searchsorted(rows[:, 0], timestamp):]
+
+
+class Telemetry():
+    """
+    Subscribes to the cyclic messages of `node_ids` on `dispatcher` (or a
+    NodeRegistry) and keeps the last `capacity` samples of each message of
+    each node.
+    """
+    def __init__(self, dispatcher: CanDispatcher, node_ids, capacity: int = 1024):
+        self.dispatcher = dispatcher
+        self.buffers = {} # (node id, cmd id) -> RingBuffer
+        self._callbacks = []
+        for node_id in node_ids:
+            for cmd_id, (_, payload, fields) in MESSAGES.items():
+                buffer = self.buffers[(node_id, cmd_id)] = RingBuffer(capacity, fields)
+                callback = self._decoder(buffer, payload)
+                dispatcher.subscribe(node_id, cmd_id, callback)
+                self._callbacks.append((node_id, cmd_id, callback))
+
+    def stop(self):
+        for node_id, cmd_id, callback in self._callbacks:
+            self.dispatcher.unsubscribe(node_id, cmd_id, callback)
+        self._callbacks = []
+
+    @staticmethod
+    def _decoder(buffer: RingBuffer, payload: struct.Struct):
+        unpack_from = payload.unpack_from
+        append = buffer.append
+        def on_message(msg):
+            append((msg.timestamp, *unpack_from(msg.data)))
+        return on_message
+
+    def buffer(self, node_id: int, message: str) -> RingBuffer:
+        """Returns the ring buffer of `message` (e.g. "encoder") for `node_id`."""
+        for cmd_id, (name, _, _) in MESSAGES.items():
+            if name == message:
+                return self.buffers[(node_id, cmd_id)]
+        raise KeyError(message)
+
+    def latest(self, node_id: int, field: str):
+        """Returns the last value of `field` (e.g. "vel_estimate") for `node_id`, or None."""
+        cmd_id, column = _FIELDS[field]
+        row = self.buffers[(node_id, cmd_id)].latest()
+        return None if row is None else row[column]
+
+    def window(self, node_id: int, field: str, seconds: float):
+        """
+        Returns a view of the values of `field` received in the last
+        `seconds` before the latest sample of that message.
+        """
+        cmd_id, column = _FIELDS[field]
+        buffer = self.buffers[(node_id, cmd_id)]
+        row = buffer.latest()
+        if row is None:
+            return buffer.last(0)[:, column]
+        return buffer.since(row[0] - seconds)[:, column]
+
+    def summary(self, node_id: int) -> str:
+        def fmt(value, unit):
+            return "-" if value is None or len(np.atleast_1d(value)) == 0 else f"{np.mean(value):.2f}{unit}"
+        error = self.latest(node_id, 'axis_error')
+        return (f"node {node_id}: errors {'-' if error is None else decode_error(int(error)).names()}, vel {fmt(self.latest(node_id, 'vel_estimate'), ' turns/s')}, "
+                f"bus {fmt(self.latest(node_id, 'bus_voltage'), ' V')} "
+                f"{fmt(self.window(node_id, 'bus_current', 1.0), ' A')} (1 s avg), "
+                f"fet {fmt(self.latest(node_id, 'fet_temperature'), ' C')}, "
+                f"motor {fmt(self.latest(node_id, 'motor_temperature'), ' C')}")
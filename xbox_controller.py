@@ -1,145 +1,248 @@
-import math
-import threading
-import evdev
-
-class XboxController(object):
-    """
-    XboxController class for interfacing with an Xbox controller using evdev.
-
-    Attributes:
-    - MAX_TRIG_VAL: Maximum trigger value.
-    - MAX_JOY_VAL: Maximum joystick value.
-    - LeftJoystickY: Y-axis value of the left joystick.
-    - LeftJoystickX: X-axis value of the left joystick.
-    - RightJoystickY: Y-axis value of the right joystick.
-    - RightJoystickX: X-axis value of the right joystick.
-    - LeftTrigger: Value of the left trigger.
-    - RightTrigger: Value of the right trigger.
-    - LeftBumper: State of the left bumper button.
-    - RightBumper: State of the right bumper button.
-    - A: State of the A button.
-    - X: State of the X button.
-    - Y: State of the Y button.
-    - B: State of the B button.
-    - LeftThumb: State of the left thumbstick button.
-    - RightThumb: State of the right thumbstick button.
-    - Back: State of the back button.
-    - Start: State of the start button.
-    - LeftDPad: State of the left direction pad button.
-    - RightDPad: State of the right direction pad button.
-    - UpDPad: State of the up direction pad button.
-    - DownDPad: State of the down direction pad button.
-    """
-
-    MAX_TRIG_VAL = 1_023
-    MAX_JOY_VAL = 32_768
-
-    def __init__(self, deadzone=0.1):
-        self._deadzone = deadzone
-        """
-        Initializes the XboxController object and starts the monitoring thread.
-        """
-        devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
-        self.device_path = ""
-        for device in devices:
-            if device.name == "Xbox Wireless Controller":
-                self.device_path = device.path
-                break
-
-        if self.device_path == "":
-            print("Controller disconnected. Exiting the controller monitor thread.")
-            self.Connected = False
-            return
-
-        self.device = evdev.InputDevice(self.device_path)
-
-        self.LeftJoystickY = 0
-        self.LeftJoystickX = 0
-        self.RightJoystickY = 0
-        self.RightJoystickX = 0
-        self.LeftTrigger = 0
-        self.RightTrigger = 0
-        self.LeftBumper = 0
-        self.RightBumper = 0
-        self.A = 0
-        self.X = 0
-        self.Y = 0
-        self.B = 0
-        self.LeftThumb = 0
-        self.RightThumb = 0
-        self.Back = 0
-        self.Start = 0
-        self.LeftDPad = 0
-        self.RightDPad = 0
-        self.UpDPad = 0
-        self.DownDPad = 0
-        self.Connected = False
-
-        self._monitor_thread = threading.Thread(target=self._monitor_controller, args=())
-        self._monitor_thread.daemon = True
-        self._monitor_thread.start()
-
-    def _monitor_controller(self):
-        """
-        Monitors the Xbox controller for input events and updates the attributes accordingly.
-        """
-        try:
-            self.Connected = True
-            for event in self.device.read_loop():
-                if event.type == evdev.ecodes.EV_ABS:
-                    if event.code == evdev.ecodes.ABS_Y:
-                        self.LeftJoystickY = self._apply_deadzone((-event.value + XboxController.MAX_JOY_VAL) / XboxController.MAX_JOY_VAL)
-                    elif event.code == evdev.ecodes.ABS_X:
-                        self.LeftJoystickX = self._apply_deadzone((event.value - XboxController.MAX_JOY_VAL) / XboxController.MAX_JOY_VAL)
-                    elif event.code == evdev.ecodes.ABS_RZ:
-                        self.RightJoystickY = self._apply_deadzone((-event.value + XboxController.MAX_JOY_VAL) / XboxController.MAX_JOY_VAL)
-                    elif event.code == evdev.ecodes.ABS_Z:
-                        self.RightJoystickX = self._apply_deadzone((event.value - XboxController.MAX_JOY_VAL) / XboxController.MAX_JOY_VAL)
-                    elif event.code == evdev.ecodes.ABS_BRAKE:
-                        self.LeftTrigger = event.value / XboxController.MAX_TRIG_VAL
-                    elif event.code == evdev.ecodes.ABS_GAS:
-                        self.RightTrigger = event.value / XboxController.MAX_TRIG_VAL
-                    elif event.code == evdev.ecodes.ABS_HAT0X:
-                        if event.value == 1:
-                            self.RightDPad = 1
-                        elif event.value == -1:
-                            self.LeftDPad = 1
-                        elif event.value == 0:
-                            self.RightDPad = self.LeftDPad = 0
-                    elif event.code == evdev.ecodes.ABS_HAT0Y:
-                        if event.value == 1:
-                            self.DownDPad = 1
-                        elif event.value == -1:
-                            self.UpDPad = 1
-                        elif event.value == 0:
-                            self.UpDPad = self.DownDPad = 0
-                elif event.type == evdev.ecodes.EV_KEY:
-                    if event.code == evdev.ecodes.BTN_TL:
-                        self.LeftBumper = event.value
-                    elif event.code == evdev.ecodes.BTN_TR:
-                        self.RightBumper = event.value
-                    elif event.code == evdev.ecodes.BTN_SOUTH:
-                        self.A = event.value
-                    elif event.code == evdev.ecodes.BTN_NORTH:
-                        self.Y = event.value
-                    elif event.code == evdev.ecodes.BTN_WEST:
-                        self.X = event.value
-                    elif event.code == evdev.ecodes.BTN_EAST:
-                        self.B = event.value
-                    elif event.code == evdev.ecodes.BTN_THUMBL:
-                        self.LeftThumb = event.value
-                    elif event.code == evdev.ecodes.BTN_THUMBR:
-                        self.RightThumb = event.value
-                    elif event.code == evdev.ecodes.BTN_SELECT:
-                        self.Back = event.value
-                    elif event.code == evdev.ecodes.BTN_START:
-                        self.Start = event.value
-        except OSError:
-            print("Controller disconnected. Exiting the controller monitor thread.")
-            self.Connected = False
-
-    def _apply_deadzone(self, value):
-        if value > 0:
-            return max(0, value - self._deadzone) / (1.0 - self._deadzone)
-        else:
-            return min(0, value + self._deadzone) / (1.0 - self._deadzone)
+import math
+import select
+import threading
+import time
+from typing import NamedTuple
+import evdev
+
+class ControllerState(NamedTuple):
+    """
+    Immutable snapshot of the controller, published atomically on every
+    SYN_REPORT. `seq` increases with every snapshot and `timestamp` is the
+    time.monotonic() at which it was published.
+    """
+    seq: int = 0
+    timestamp: float = 0.0
+    Connected: bool = False
+    LeftJoystickY: float = 0
+    LeftJoystickX: float = 0
+    RightJoystickY: float = 0
+    RightJoystickX: float = 0
+    LeftTrigger: float = 0
+    RightTrigger: float = 0
+    LeftBumper: int = 0
+    RightBumper: int = 0
+    A: int = 0
+    X: int = 0
+    Y: int = 0
+    B: int = 0
+    LeftThumb: int = 0
+    RightThumb: int = 0
+    Back: int = 0
+    Start: int = 0
+    LeftDPad: int = 0
+    RightDPad: int = 0
+    UpDPad: int = 0
+    DownDPad: int = 0
+
+class XboxController(object):
+    """
+    XboxController class for interfacing with an Xbox controller using evdev.
+
+    Attributes:
+    - MAX_TRIG_VAL: Maximum trigger value.
+    - MAX_JOY_VAL: Maximum joystick value.
+    - LeftJoystickY: Y-axis value of the left joystick.
+    - LeftJoystickX: X-axis value of the left joystick.
+    - RightJoystickY: Y-axis value of the right joystick.
+    - RightJoystickX: X-axis value of the right joystick.
+    - LeftTrigger: Value of the left trigger.
+    - RightTrigger: Value of the right trigger.
+    - LeftBumper: State of the left bumper button.
+    - RightBumper: State of the right bumper button.
+    - A: State of the A button.
+    - X: State of the X button.
+    - Y: State of the Y button.
+    - B: State of the B button.
+    - LeftThumb: State of the left thumbstick button.
+    - RightThumb: State of the right thumbstick button.
+    - Back: State of the back button.
+    - Start: State of the start button.
+    - LeftDPad: State of the left direction pad button.
+    - RightDPad: State of the right direction pad button.
+    - UpDPad: State of the up direction pad button.
+    - DownDPad: State of the down direction pad button.
+    - Connected: Whether the controller is connected.
+
+    The attributes above read from the latest snapshot, so two of them read
+    one after the other may come from different reports. Use snapshot() to
+    get all of them from the same report, and wait_for_update() or
+    add_listener() to react to a report as soon as it is published.
+    """
+
+    MAX_TRIG_VAL = 1_023
+    MAX_JOY_VAL = 32_768
+
+    def __init__(self, deadzone=0.1):
+        self._deadzone = deadzone
+        """
+        Initializes the XboxController object and starts the monitoring thread.
+        """
+        self._state = ControllerState()
+        self._update = threading.Condition()
+        self._listeners = []
+
+        devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
+        self.device_path = ""
+        for device in devices:
+            if device.name == "Xbox Wireless Controller":
+                self.device_path = device.path
+                break
+
+        if self.device_path == "":
+            print("Controller disconnected. Exiting the controller monitor thread.")
+            return
+
+        self.device = evdev.InputDevice(self.device_path)
+
+        self._monitor_thread = threading.Thread(target=self._monitor_controller, args=())
+        self._monitor_thread.daemon = True
+        self._monitor_thread.start()
+
+    def __getattr__(self, name):
+        # Only called for names that aren't regular attributes, i.e. the inputs
+        return getattr(self._state, name)
+
+    def snapshot(self) -> ControllerState:
+        """Returns the latest published snapshot."""
+        return self._state
+
+    def wait_for_update(self, seq: int, timeout=None) -> ControllerState:
+        """
+        Blocks until a snapshot newer than `seq` is published or `timeout`
+        expires, then returns the latest snapshot.
+        """
+        with self._update:
+            self._update.wait_for(lambda: self._state.seq != seq, timeout)
+            return self._state
+
+    def add_listener(self, callback):
+        """Calls `callback(state)` from the monitoring thread for every new snapshot."""
+        self._listeners.append(callback)
+
+    def _publish(self, values, connected: bool):
+        state = ControllerState._make((self._state.seq + 1, time.monotonic(), connected, *values))
+        with self._update:
+            self._state = state
+            self._update.notify_all()
+        for callback in self._listeners:
+            callback(state)
+
+    def _build_decoder(self):
+        """
+        Returns the dispatch table used by _monitor_controller, keyed by
+        (event type, event code). Each entry is (kind, field index, scale,
+        offset) with the normalisation and deadzone constants folded in.
+        """
+        ecodes = evdev.ecodes
+        index = {field: i for i, field in enumerate(_INPUT_FIELDS)}
+        joy = 1.0 / XboxController.MAX_JOY_VAL
+        trig = 1.0 / XboxController.MAX_TRIG_VAL
+
+        table = {
+            # Sticks: value * scale + offset is in [-1, 1], then the deadzone is applied
+            (ecodes.EV_ABS, ecodes.ABS_Y): (_STICK, index['LeftJoystickY'], -joy, 1.0),
+            (ecodes.EV_ABS, ecodes.ABS_X): (_STICK, index['LeftJoystickX'], joy, -1.0),
+            (ecodes.EV_ABS, ecodes.ABS_RZ): (_STICK, index['RightJoystickY'], -joy, 1.0),
+            (ecodes.EV_ABS, ecodes.ABS_Z): (_STICK, index['RightJoystickX'], joy, -1.0),
+            (ecodes.EV_ABS, ecodes.ABS_BRAKE): (_LINEAR, index['LeftTrigger'], trig, 0.0),
+            (ecodes.EV_ABS, ecodes.ABS_GAS): (_LINEAR, index['RightTrigger'], trig, 0.0),
+            # Hats: field index for -1 and field index for 1
+            (ecodes.EV_ABS, ecodes.ABS_HAT0X): (_HAT, index['LeftDPad'], index['RightDPad'], None),
+            (ecodes.EV_ABS, ecodes.ABS_HAT0Y): (_HAT, index['UpDPad'], index['DownDPad'], None),
+        }
+        buttons = {
+            ecodes.BTN_TL: 'LeftBumper', ecodes.BTN_TR: 'RightBumper',
+            ecodes.BTN_SOUTH: 'A', ecodes.BTN_NORTH: 'Y', ecodes.BTN_WEST: 'X', ecodes.BTN_EAST: 'B',
+            ecodes.BTN_THUMBL: 'LeftThumb', ecodes.BTN_THUMBR: 'RightThumb',
+            ecodes.BTN_SELECT: 'Back', ecodes.BTN_START: 'Start',
+        }
+        for code, field in buttons.items():
+            table[(ecodes.EV_KEY, code)] = (_BUTTON, index[field], None, None)
+        return table
+
+    def _monitor_controller(self):
+        """
+        Monitors the Xbox controller for input events and publishes a new snapshot for every SYN_REPORT.
+
+        All pending events are read in one batch. Values simply overwrite each
+        other, so only the last value of each input in a report is kept, and
+        only the last complete report of a batch is published. After the
+        kernel dropped events (SYN_DROPPED), the inputs are read back from
+        the device state.
+        """
+        ecodes = evdev.ecodes
+        decoder = self._build_decoder()
+        deadzone = self._deadzone
+        gain = 1.0 / (1.0 - deadzone)
+
+        # Values being accumulated for the next report
+        values = [getattr(self._state, field) for field in _INPUT_FIELDS]
+        dropped = False
+
+        def apply(entry, value):
+            kind, i, scale, offset = entry
+            if kind is _STICK:
+                value = value * scale + offset
+                if value > deadzone:
+                    values[i] = (value - deadzone) * gain
+                elif value < -deadzone:
+                    values[i] = (value + deadzone) * gain
+                else:
+                    values[i] = 0.0
+            elif kind is _BUTTON:
+                values[i] = value
+            elif kind is _LINEAR:
+                values[i] = value * scale
+            else: # _HAT
+                values[i] = 1 if value == -1 else 0
+                values[scale] = 1 if value == 1 else 0
+
+        def resync():
+            # Events lost in an overflow (e.g. a button release) only show in the device state
+            active_keys = set(self.device.active_keys())
+            for (event_type, code), entry in decoder.items():
+                if event_type == ecodes.EV_KEY:
+                    apply(entry, 1 if code in active_keys else 0)
+                else:
+                    apply(entry, self.device.absinfo(code).value)
+
+        try:
+            self._publish(values, True)
+            while True:
+                select.select([self.device.fd], [], [])
+                report = None
+                try:
+                    for event in self.device.read():
+                        if event.type == ecodes.EV_SYN:
+                            if event.code == ecodes.SYN_REPORT:
+                                if dropped:
+                                    resync()
+                                report = tuple(values)
+                                dropped = False
+                            elif event.code == ecodes.SYN_DROPPED:
+                                # The kernel buffer overflowed: ignore everything up to
+                                # the next report, then read the state from the device
+                                dropped = True
+                            continue
+                        entry = decoder.get((event.type, event.code))
+                        if entry is None or dropped:
+                            continue
+                        apply(entry, event.value)
+                except BlockingIOError:
+                    pass # nothing left to read
+                if report is not None:
+                    self._publish(report, True)
+        except OSError:
+            print("Controller disconnected. Exiting the controller monitor thread.")
+            # Neutral inputs, so nobody keeps acting on what was held before the disconnect
+            self._publish([0] * len(_INPUT_FIELDS), False)
+
+
+_INPUT_FIELDS = ControllerState._fields[3:] # everything but seq, timestamp and Connected
+
+# Decoder entry kinds, see XboxController._build_decoder
+_STICK = "stick"
+_LINEAR = "linear"
+_BUTTON = "button"
+_HAT = "hat"